@@ -14,26 +14,25 @@ PERIOD_NAMES = {
     'all': '📅 Всё время'
 }
 
+# Статические клавиатуры истории - создаются один раз
+HISTORY_MENU_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(name, callback_data=f'hist_period_{period}')] for period, name in PERIOD_NAMES.items()]
+    + [[InlineKeyboardButton("« Назад", callback_data='back')]]
+)
+TO_PERIODS_ROW = [InlineKeyboardButton("« К периодам", callback_data='history')]
+TO_PERIODS_MARKUP = InlineKeyboardMarkup([TO_PERIODS_ROW])
+
 
 async def show_history_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, history_manager):
     """Главное меню истории - выбор периода"""
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [InlineKeyboardButton("📅 Сегодня", callback_data='hist_period_today')],
-        [InlineKeyboardButton("📅 Вчера", callback_data='hist_period_yesterday')],
-        [InlineKeyboardButton("📅 Эта неделя", callback_data='hist_period_week')],
-        [InlineKeyboardButton("📅 Этот месяц", callback_data='hist_period_month')],
-        [InlineKeyboardButton("📅 Всё время", callback_data='hist_period_all')],
-        [InlineKeyboardButton("« Назад", callback_data='back')]
-    ]
-    
     await query.edit_message_text(
         "📜 <b>ИСТОРИЯ ТОРГОВЛИ</b>\n\n"
         "Выберите период:",
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=HISTORY_MENU_MARKUP
     )
 
 
@@ -50,14 +49,10 @@ async def show_period_summary(update: Update, context: ContextTypes.DEFAULT_TYPE
     if stats['total_trades'] == 0:
         text = f"📜 <b>{period_name}</b>\n\nℹ️ Нет сделок за этот период"
         
-        keyboard = [
-            [InlineKeyboardButton("« К периодам", callback_data='history')]
-        ]
-        
         await query.edit_message_text(
             text,
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TO_PERIODS_MARKUP
         )
         return
     
@@ -91,7 +86,7 @@ async def show_period_summary(update: Update, context: ContextTypes.DEFAULT_TYPE
     keyboard = [
         [InlineKeyboardButton("📋 Детали", callback_data=f'hist_details_{period}')],
         [InlineKeyboardButton("🔄 Обновить", callback_data=f'hist_period_{period}')],
-        [InlineKeyboardButton("« К периодам", callback_data='history')]
+        TO_PERIODS_ROW
     ]
     
     await query.edit_message_text(
@@ -126,8 +121,11 @@ async def show_period_details(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     period_name = PERIOD_NAMES.get(period, period)
     
-    text = f"📜 <b>{period_name} - Детали</b>\n"
-    text += f"Страница {page + 1}/{total_pages}\n\n"
+    # Строки сообщения собираем в список и склеиваем один раз
+    lines = [
+        f"📜 <b>{period_name} - Детали</b>\n",
+        f"Страница {page + 1}/{total_pages}\n\n",
+    ]
     
     for i, trade in enumerate(page_trades, start=start_idx + 1):
         pnl_emoji = "🟢" if trade['net_pnl'] >= 0 else "🔴"
@@ -137,17 +135,19 @@ async def show_period_details(update: Update, context: ContextTypes.DEFAULT_TYPE
         trade_time = datetime.fromisoformat(trade['timestamp'])
         time_str = trade_time.strftime("%d.%m %H:%M")
         
-        text += f"<b>#{i}. {side_emoji} {trade['symbol']}</b> ({time_str})\n"
-        text += f"  💰 Entry: ${trade['entry_price']:,.2f}\n"
-        text += f"  💰 Exit: ${trade['exit_price']:,.2f}\n"
-        text += f"  📊 Size: {trade['size']:.2f} (x{trade['leverage']})\n"
-        text += f"  {pnl_emoji} P&L: ${trade['net_pnl']:+,.2f} ({trade['roi_percent']:+.2f}% ROI)\n"
+        lines.append(
+            f"<b>#{i}. {side_emoji} {trade['symbol']}</b> ({time_str})\n"
+            f"  💰 Entry: ${trade['entry_price']:,.2f}\n"
+            f"  💰 Exit: ${trade['exit_price']:,.2f}\n"
+            f"  📊 Size: {trade['size']:.2f} (x{trade['leverage']})\n"
+            f"  {pnl_emoji} P&L: ${trade['net_pnl']:+,.2f} ({trade['roi_percent']:+.2f}% ROI)\n"
+        )
         
         total_fees = trade['entry_fee'] + trade['exit_fee']
         if total_fees > 0:
-            text += f"  💸 Fees: ${total_fees:.2f}\n"
+            lines.append(f"  💸 Fees: ${total_fees:.2f}\n")
         
-        text += "\n"
+        lines.append("\n")
     
     # Кнопки навигации
     keyboard = []
@@ -164,7 +164,7 @@ async def show_period_details(update: Update, context: ContextTypes.DEFAULT_TYPE
     keyboard.append([InlineKeyboardButton("« К сводке", callback_data=f'hist_period_{period}')])
     
     await query.edit_message_text(
-        text,
+        "".join(lines),
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
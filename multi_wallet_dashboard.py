@@ -2,9 +2,11 @@
 Multi-Wallet Trading Dashboard
 Управление торговлей с нескольких кошельков
 """
+import os
 import config
 from trading_dashboard_v2 import TradingDashboard, PRODUCTS
 from nado_protocol.client import create_nado_client, NadoClientMode
+from nado_protocol.utils import SubaccountParams, subaccount_to_hex
 import logging
 
 logger = logging.getLogger(__name__)
@@ -60,7 +62,6 @@ class MultiWalletDashboard:
         else:
             # НЕТ SUBACCOUNT - торгуем НАПРЯМУЮ с кошелька
             # Создаём sender_hex: адрес + padding нулями до 32 байт
-            from nado_protocol.utils import SubaccountParams, subaccount_to_hex
             params = SubaccountParams(
                 subaccount_owner=dashboard.wallet,
                 subaccount_name=""  # Пустая строка = торговля напрямую
@@ -74,7 +75,6 @@ class MultiWalletDashboard:
         dashboard.margin_mode = "AUTO"
         
         # Хранилище для entry prices (разные файлы для каждого кошелька)
-        import os
         dashboard.positions_file = os.path.join(
             os.path.dirname(__file__), 
             f"positions_data_wallet{wallet_num}.json"
@@ -98,6 +98,8 @@ class MultiWalletDashboard:
         """Переключиться на другой кошелек"""
         if wallet_num not in self.wallets:
             raise ValueError(f"Кошелек {wallet_num} не инициализирован")
+        if wallet_num == self.active_wallet:
+            return
         self.active_wallet = wallet_num
         logger.info(f"🔄 Переключено на Wallet {wallet_num}")
     
@@ -105,20 +107,21 @@ class MultiWalletDashboard:
         """Получить текущий активный dashboard"""
         return self.wallets[self.active_wallet]
     
+    def get_wallet_balance(self, wallet_num: int):
+        """Баланс одного кошелька: {'address', 'balance'} или None при ошибке"""
+        dashboard = self.wallets[wallet_num]
+        try:
+            return {
+                'address': dashboard.wallet,
+                'balance': dashboard.get_balance()
+            }
+        except Exception as e:
+            logger.error(f"Ошибка получения баланса кошелька {wallet_num}: {e}")
+            return None
+    
     def get_all_balances(self):
         """Получить балансы всех кошельков"""
-        balances = {}
-        for wallet_num, dashboard in self.wallets.items():
-            try:
-                balance = dashboard.get_balance()
-                balances[wallet_num] = {
-                    'address': dashboard.wallet,
-                    'balance': balance
-                }
-            except Exception as e:
-                logger.error(f"Ошибка получения баланса кошелька {wallet_num}: {e}")
-                balances[wallet_num] = None
-        return balances
+        return {wallet_num: self.get_wallet_balance(wallet_num) for wallet_num in self.wallets}
     
     def get_all_positions(self):
         """Получить позиции со всех кошельков"""
@@ -174,6 +177,18 @@ class MultiWalletDashboard:
     def get_positions(self):
         return self.get_current_dashboard().get_positions()
     
+    def get_positions_by_id(self):
+        return self.get_current_dashboard().get_positions_by_id()
+    
+    def get_positions_cached(self, *args, **kwargs):
+        return self.get_current_dashboard().get_positions_cached(*args, **kwargs)
+    
+    def get_position(self, *args, **kwargs):
+        return self.get_current_dashboard().get_position(*args, **kwargs)
+    
+    def get_positions_snapshot(self, *args, **kwargs):
+        return self.get_current_dashboard().get_positions_snapshot(*args, **kwargs)
+    
     def place_order(self, *args, **kwargs):
         return self.get_current_dashboard().place_order(*args, **kwargs)
     
@@ -201,3 +216,6 @@ class MultiWalletDashboard:
     
     def place_limit_close_order(self, *args, **kwargs):
         return self.get_current_dashboard().place_limit_close_order(*args, **kwargs)
+    
+    def save_entry_price(self, *args, **kwargs):
+        return self.get_current_dashboard().save_entry_price(*args, **kwargs)
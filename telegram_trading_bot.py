@@ -5,20 +5,33 @@ import logging
 import os
 import sys
 import json
+import re
+import random
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
+from telegram.error import RetryAfter
+from telegram.ext import Application, AIORateLimiter, BaseRateLimiter, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, TypeHandler, filters, ConversationHandler
+from nado_protocol.engine_client.types.execute import CancelProductOrdersParams
 import config
 # Import Multi-Wallet Dashboard
 sys.path.insert(0, os.path.dirname(__file__))
 from multi_wallet_dashboard import MultiWalletDashboard
-from trading_dashboard_v2 import PRODUCTS
+from trading_dashboard_v2 import PRODUCTS, PRODUCT_BASES, SIZE_INCREMENTS, POSITIONS_CACHE_TTL
 from tp_sl_calculator import TPSLCalculator
 from trade_history_manager import TradeHistoryManager
+from trading_math import calc_pnl, calc_target_price, calc_fee, calc_liquidation
 from history_handlers import show_history_menu, show_period_summary, show_period_details
 from decimal import Decimal
 import asyncio
 import time
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import OrderedDict
+from operator import itemgetter
+
+# uvloop - опционально: есть только на Linux/macOS (сервер), на Windows работаем на стандартном loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Logging setup
 logging.basicConfig(
@@ -27,20 +40,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Rate limiting
-user_cooldowns = {}
+# Исходящие запросы к Telegram: не больше TG_MAX_RATE в секунду на весь бот (лимит API - 30)
+TG_MAX_RATE = 28
+# Сколько раз повторять запрос, отклонённый Telegram с 429 (RetryAfter)
+TG_MAX_RETRIES = 8
+
+
+class RetryAfterLimiter(BaseRateLimiter):
+    """Запасной вариант без aiolimiter: без ограничения частоты, только повтор запросов
+    после 429 - ждём retry_after от Telegram, но не меньше экспоненциального шага, плюс jitter"""
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        for attempt in range(TG_MAX_RETRIES):
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == TG_MAX_RETRIES - 1:
+                    raise
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                delay = max(float(retry_after), min(32, 2 ** attempt)) + random.random()
+                logger.warning(f"⏳ Telegram 429 на {endpoint}: повтор через {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+# Rate limiting: user_id -> time.monotonic_ns() последнего действия.
+# OrderedDict в порядке последнего обращения - самые старые записи вытесняются
+USER_COOLDOWNS_MAX = 100_000
+user_cooldowns = OrderedDict()
 
 def rate_limit(seconds=2):
     """Rate limiting decorator для предотвращения спама"""
+    limit_ns = int(seconds * 1_000_000_000)
+    
     def decorator(func):
         @wraps(func)
         async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = update.effective_user.id
-            now = time.time()
+            now = time.monotonic_ns()
             
             # Проверяем cooldown
-            if user_id in user_cooldowns:
-                if now - user_cooldowns[user_id] < seconds:
+            last = user_cooldowns.get(user_id)
+            if last is not None:
+                if now - last < limit_ns:
                     # Пользователь спамит
                     if update.callback_query:
                         await update.callback_query.answer(
@@ -51,10 +99,45 @@ def rate_limit(seconds=2):
             
             # Обновляем время последнего действия
             user_cooldowns[user_id] = now
+            user_cooldowns.move_to_end(user_id)
+            if len(user_cooldowns) > USER_COOLDOWNS_MAX:
+                user_cooldowns.popitem(last=False)
             return await func(update, context)
         return wrapper
     return decorator
 
+# Повторные нажатия той же кнопки: (user_id, message_id, callback_data) -> monotonic() окончания
+# обработки, None - ещё обрабатывается. Дубль во время обработки или сразу после неё
+# (двойной клик, ставший в очередь) отбрасывается
+DUPLICATE_CALLBACK_WINDOW = 1.0
+_callbacks_seen = {}
+
+def drop_duplicate_callbacks(func):
+    """Отбросить повторное нажатие кнопки, пока первое не обработано (и DUPLICATE_CALLBACK_WINDOW после)"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        key = (query.from_user.id, query.message.message_id if query.message else None, query.data)
+        now = time.monotonic()
+        
+        if key in _callbacks_seen:
+            done_at = _callbacks_seen[key]
+            if done_at is None or now - done_at < DUPLICATE_CALLBACK_WINDOW:
+                await query.answer()
+                return
+        
+        _callbacks_seen[key] = None
+        try:
+            return await func(update, context)
+        finally:
+            done_at = time.monotonic()
+            _callbacks_seen[key] = done_at
+            # Чистим устаревшие записи, чтобы словарь не рос
+            if len(_callbacks_seen) > 1000:
+                for stale in [k for k, t in _callbacks_seen.items() if t is not None and done_at - t > DUPLICATE_CALLBACK_WINDOW]:
+                    del _callbacks_seen[stale]
+    return wrapper
+
 # Helper functions for wallet-specific data
 def get_wallet_key(context, key_name):
     """Get wallet-specific key name"""
@@ -77,7 +160,7 @@ async def send_error_with_retry(query, error_msg, retry_callback=None):
     keyboard = []
     if retry_callback:
         keyboard.append([InlineKeyboardButton("🔄 Попробовать снова", callback_data=retry_callback)])
-    keyboard.append([InlineKeyboardButton("« Назад", callback_data='back')])
+    keyboard.append(BACK_RU_ROW)
     
     await query.edit_message_text(
         f"❌ {error_msg}",
@@ -118,15 +201,228 @@ def save_user_data(user_id, data):
     with open(USER_DATA_FILE, 'w') as f:
         json.dump(all_data, f, indent=2)
 
+# Риск-калькулятор подтверждения: типичные TP/SL и их соотношение - константы
+TYPICAL_TP_PCT = 5.0
+TYPICAL_SL_PCT = 2.0
+RR_RATIO = TYPICAL_TP_PCT / TYPICAL_SL_PCT
+
+# Шаблон подтверждения ордера (строка Risk/Reward постоянна - подставляется один раз)
+ORDER_CONFIRM_TMPL = (
+    "<b>Confirmation {direction}</b>\n\n"
+    "📊 {symbol}\n"
+    "💰 Цена: ${price:,.2f}\n"
+    "📦 Base size: {size}\n"
+    "⚡ Leverage: {leverage}x\n"
+    "📈 Position size: {position_size}\n"
+    "💵 Notional: ${notional:,.2f}\n\n"
+    "💰 <b>Fees:</b>\n"
+    "  Opening: ${open_fee:,.4f}\n"
+    "  Closing: ${close_fee:,.4f}\n"
+    "  Total: ${total_fee:,.4f}\n\n"
+    "⚠️ <b>RISK:</b>\n"
+    "  🔻 Ликвидация: ${liq_price:,.2f} ({liq_percent:.1f}%)\n"
+    f"  📊 Risk/Reward: 1:{RR_RATIO:.1f} (TP {TYPICAL_TP_PCT}% / SL {TYPICAL_SL_PCT}%)\n\n"
+    "Open position?"
+)
+
+# Уведомления мониторинга о сработавших TP/SL
+TP_HIT_TMPL = (
+    "🎯 <b>TAKE PROFIT СРАБОТАЛ!</b>\n\n"
+    "📊 {symbol} {side}\n"
+    "💰 Вход: ${entry_price:,.2f}\n"
+    "💰 TP: ${tp_price:,.2f}\n"
+    "🟢 <b>Профит: ${pnl:+,.2f}</b>"
+)
+SL_HIT_TMPL = (
+    "🛑 <b>STOP LOSS СРАБОТАЛ!</b>\n\n"
+    "📊 {symbol} {side}\n"
+    "💰 Вход: ${entry_price:,.2f}\n"
+    "💰 SL: ${sl_price:,.2f}\n"
+    "🔴 <b>Убыток: ${pnl:+,.2f}</b>"
+)
+
+# Меню выбора режима TP/SL (общее для обоих видов)
+TPSL_MENU_TMPL = (
+    "{icon} <b>УСТАНОВИТЬ {title}</b>\n\n"
+    "📊 {symbol} {side}\n"
+    "💰 Вход: {entry}\n"
+    "💰 Сейчас: ${current_price:,.2f}\n\n"
+    "Выберите режим:"
+)
+
+# Подтверждение установки TP/SL
+TP_CONFIRM_TMPL = (
+    "🎯 <b>ПОДТВЕРЖДЕНИЕ TP</b>\n\n"
+    "📊 {symbol} {side}\n"
+    "💰 Вход: ${entry_price:,.2f}\n"
+    "💰 Сейчас: ${current_price:,.2f}\n"
+    "🎯 TP: ${target_price:,.2f}\n\n"
+    "Ожидаемый профит:\n"
+    "📈 {percent:+.2f}%\n"
+    "💵 ${pnl:+,.2f}\n\n"
+    "Установить TP?"
+)
+SL_CONFIRM_TMPL = (
+    "🛑 <b>ПОДТВЕРЖДЕНИЕ SL</b>\n\n"
+    "📊 {symbol} {side}\n"
+    "💰 Вход: ${entry_price:,.2f}\n"
+    "💰 Сейчас: ${current_price:,.2f}\n"
+    "🛑 SL: ${target_price:,.2f}\n\n"
+    "Ожидаемый убыток:\n"
+    "📉 {percent:.2f}%\n"
+    "💵 ${pnl:+,.2f}\n\n"
+    "Установить SL?"
+)
+TPSL_CONFIRM_TMPLS = {'tp': TP_CONFIRM_TMPL, 'sl': SL_CONFIRM_TMPL}
+
+# Поля позиции из снимка, которые нужны экрану позиций - распаковываются одним вызовом
+POSITION_FIELDS = itemgetter(
+    'product_id', 'symbol', 'side', 'amount', 'price', 'notional', 'entry_price', 'tp_price', 'sl_price'
+)
+
+# Главное меню, баланс и блок позиции на экране позиций
+WELCOME_TMPL = (
+    "🤖 <b>NADO DEX Trading Bot</b>\n\n"
+    "🌐 Network: <code>{network}</code>\n"
+    "👛 Wallet: <code>{wallet}</code>\n"
+    "⚡ Leverage: <code>{leverage}x</code>\n\n"
+    "Выберите действие:"
+)
+BALANCE_TMPL = (
+    "💰 <b>ACCOUNT BALANCE</b>\n\n"
+    "Total Equity: <b>${equity:,.2f}</b>\n"
+    "Available Margin: <b>${health:,.2f}</b>\n"
+)
+POSITION_TMPL = (
+    "{side_emoji} <b>{symbol}</b>\n"
+    "├ Размер: {amount:.4f}\n"
+    "├ Вход: {entry}\n"
+    "├ Сейчас: ${current_price:,.2f}\n"
+    "├ Объем: ${notional:,.2f}\n"
+    "└ P&L: {pnl_emoji} ${pnl:+,.2f} ({pnl_percent:+.2f}%)\n"
+)
+
+# Подтверждение закрытия позиции
+CLOSE_CONFIRM_TMPL = (
+    "⚠️ <b>ЗАКРЫТЬ ПОЗИЦИЮ?</b>\n\n"
+    "📊 {symbol} {side}\n"
+    "💰 Вход: ${entry_price:,.2f}\n"
+    "💰 Сейчас: ${current_price:,.2f}\n"
+    "📏 Размер: {amount:.4f}\n\n"
+    "{pnl_emoji} <b>P&L: ${pnl:+,.2f} ({pnl_percent:+.2f}%)</b>\n\n"
+    "Подтвердите закрытие:"
+)
+
 # Conversation states
 WAITING_WALLET, WAITING_PRODUCT, WAITING_SIZE, WAITING_LEVERAGE = range(4)
 WAITING_TPSL_PRODUCT = 9
 WAITING_TP_MODE, WAITING_TP_PRICE, WAITING_TP_PERCENT = range(10, 13)
 WAITING_SL_MODE, WAITING_SL_PRICE, WAITING_SL_PERCENT = range(13, 16)
 
+# Брошенные диалоги завершаются через 10 минут, их данные удаляются из user_data
+CONVERSATION_TIMEOUT = 600
+# Ключи user_data каждого диалога - по таймауту диалог удаляет только свои
+OPEN_POSITION_KEYS = ('is_long', 'wallet_num', 'dashboard', 'product_id')
+TPSL_SETUP_KEYS = (
+    'tp_product_id', 'tp_mode', 'tp_position', 'tp_entry_price', 'tp_price',
+    'sl_product_id', 'sl_mode', 'sl_position', 'sl_entry_price', 'sl_price',
+)
+SESSION_EXPIRED_TEXT = "❌ Сессия истекла - начните заново"
+
+# Шаблоны callback_data - компилируются один раз, общие для регистрации и разбора
+CB_CONFIRM_ORDER = re.compile(r'^confirm_order_(.+)$')
+CB_CLOSE = re.compile(r'^close_(\d+)$')
+CB_CONFIRM_CLOSE = re.compile(r'^confirm_close_(\d+)$')
+CB_CANCEL_ORDERS = re.compile(r'^cancel_orders_(\d+)$')
+CB_SWITCH_WALLET = re.compile(r'^switch_wallet_(\d+)(?:_(\w+))?$')
+CB_CONFIRM_TP = re.compile(r'^confirm_tp_order$')
+CB_CONFIRM_SL = re.compile(r'^confirm_sl_order$')
+CB_SET_TPSL = re.compile(r'^set_(tp|sl)_(\d+)$')
+CB_TPSL_MODE = re.compile(r'^(tp|sl)_mode_(price|percent)$')
+CB_PRODUCT = re.compile(r'^product_(\d+)$')
+CB_POSITION_WALLET = re.compile(r'^switch_wallet_(\d+)$')
+CB_HIST_PERIOD = re.compile(r'^hist_period_(\w+)$')
+CB_HIST_DETAILS = re.compile(r'^hist_details_([a-z]+)(?:_(\d+))?$')
+
+# Числовой ввод пользователя (цена/процент) - проверяется без исключений
+NUMBER_RE = re.compile(r'^[+-]?(?:\d+\.?\d*|\.\d+)$')
+
 # Temporary user data storage
 user_data_storage = {}
 
+# Ссылки на фоновые задачи - иначе asyncio может собрать их GC до завершения
+BACKGROUND_TASKS = set()
+
+
+def parse_number(text):
+    """Разобрать число из ввода пользователя, None если формат неверный"""
+    text = text.strip()
+    return float(text) if NUMBER_RE.match(text) else None
+
+
+@lru_cache(maxsize=256)
+def fmt_usd(value):
+    """Цена в виде $1,234.56 - сохранённые цены (вход, TP, SL) повторяются между экранами"""
+    return f"${value:,.2f}"
+
+
+# Кэш рыночных цен для экранов меню {product_id: (ts, price)}
+_price_cache = {}
+_PRICE_TTL = 1.0
+
+
+def get_cached_price(dash, product_id):
+    """Рыночная цена для отображения - повторные запросы в пределах _PRICE_TTL берутся из кэша"""
+    now = time.monotonic()
+    cached = _price_cache.get(product_id)
+    if cached and now - cached[0] < _PRICE_TTL:
+        return cached[1]
+    price = dash.get_market_price(product_id)
+    if price:
+        _price_cache[product_id] = (now, price)
+    return price
+
+
+def _background_task_done(task):
+    """Убрать задачу из BACKGROUND_TASKS и залогировать её ошибку"""
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()!r}")
+
+
+def spawn(coro):
+    """Запустить корутину в фоне, удерживая ссылку на задачу до её завершения"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+
+def ack(query):
+    """Ответить на callback в фоне - «часики» снимаются параллельно с основной работой хендлера"""
+    return spawn(query.answer())
+
+
+async def run_with_progress(query, text, func, *args, **kwargs):
+    """Показать сообщение «в процессе» и одновременно выполнить блокирующий вызов в потоке.
+    Результат возвращается, когда завершены оба - итоговый edit не обгонит промежуточный"""
+    progress = spawn(query.edit_message_text(text))
+    try:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    finally:
+        await asyncio.wait((progress,))
+
+
+def run_in_background(func, *args, **kwargs):
+    """Запустить блокирующую функцию в потоке, не дожидаясь результата"""
+    return spawn(asyncio.to_thread(func, *args, **kwargs))
+
+# Мониторинг TP/SL: частая проверка пока есть открытые позиции, редкая сверка без них
+MONITOR_INTERVAL = 15
+MONITOR_IDLE_INTERVAL = 60
+# Будит монитор сразу после ордеров из бота, не дожидаясь конца интервала
+MONITOR_WAKEUP = asyncio.Event()
+
 # Allowed users - ПУСТОЙ список = доступ для ВСЕХ
 ALLOWED_USERS = []
 
@@ -140,6 +436,84 @@ def check_access(update: Update) -> bool:
     return user_id in ALLOWED_USERS
 
 
+async def broadcast(bot, text):
+    """Отправить сообщение всем ALLOWED_USERS параллельно"""
+    results = await asyncio.gather(
+        *(bot.send_message(user_id, text, parse_mode='HTML') for user_id in ALLOWED_USERS),
+        return_exceptions=True
+    )
+    for user_id, result in zip(ALLOWED_USERS, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error sending notification to {user_id}: {result}")
+
+
+# Статические строки для клавиатур с динамической частью
+BACK_RU_ROW = [InlineKeyboardButton("« Назад", callback_data='back')]
+BACK_TO_POSITIONS_ROW = [InlineKeyboardButton("« Назад", callback_data='positions')]
+
+# Статические клавиатуры - создаются один раз и переиспользуются всеми хендлерами
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back')]])
+TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« To menu", callback_data='back')]])
+BACK_RU_MARKUP = InlineKeyboardMarkup([BACK_RU_ROW])
+TO_MENU_RU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« К меню", callback_data='back')]])
+BACK_TO_WALLETS_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='wallets_menu')]])
+BACK_TO_POSITIONS_MARKUP = InlineKeyboardMarkup([BACK_TO_POSITIONS_ROW])
+TO_POSITIONS_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« К позициям", callback_data='positions')]])
+# Экран позиций без позиций: отмена ордеров по каждой паре, обновить, назад
+NO_POSITIONS_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(f"🚫 Отменить {symbol}", callback_data=f'cancel_orders_{pid}')] for pid, symbol in PRODUCTS.items()]
+    + [[InlineKeyboardButton("🔄 Обновить", callback_data='positions')], BACK_RU_ROW]
+)
+TP_MODE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 По цене ($)", callback_data='tp_mode_price')],
+    [InlineKeyboardButton("📊 По проценту (%)", callback_data='tp_mode_percent')],
+    BACK_TO_POSITIONS_ROW
+])
+SL_MODE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 По цене ($)", callback_data='sl_mode_price')],
+    [InlineKeyboardButton("📊 По проценту (%)", callback_data='sl_mode_percent')],
+    BACK_TO_POSITIONS_ROW
+])
+# Подтверждение TP/SL - цена хранится в user_data, поэтому клавиатуры статические
+TPSL_CONFIRM_MARKUPS = {
+    kind: InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Да", callback_data=f'confirm_{kind}_order'),
+        InlineKeyboardButton("❌ Нет", callback_data='positions')
+    ]])
+    for kind in ('tp', 'sl')
+}
+
+# Статическая строка для клавиатур с динамической частью (retry и т.п.)
+CANCEL_ROW = [InlineKeyboardButton("« Cancel", callback_data='back')]
+
+# Кнопка возврата для сообщений об ошибках по callback_data назначения
+ERROR_BACK_MARKUPS = {
+    'back': BACK_MARKUP,
+    'positions': BACK_TO_POSITIONS_MARKUP,
+    'wallets_menu': BACK_TO_WALLETS_MARKUP,
+}
+
+
+async def edit_error(query, text, back_cb='back'):
+    """Показать ошибку с готовой кнопкой возврата"""
+    await query.edit_message_text(text, reply_markup=ERROR_BACK_MARKUPS[back_cb])
+
+
+async def edit_view(query, context, text, reply_markup):
+    """Перерисовать обновляемый экран (статус, позиции) и ответить на callback.
+    Если ни данные, ни сообщение не изменились - только короткий ответ: повторный edit
+    с тем же текстом Telegram всё равно отклоняет ("message is not modified")"""
+    view = (query.message.message_id, hash(text))
+    last = context.user_data.get('_last_view')
+    if last and last[0] == view and last[1] == query.message.text:
+        await query.answer("✓ Без изменений")
+        return
+    ack(query)
+    message = await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
+    context.user_data['_last_view'] = (view, getattr(message, 'text', None))
+
+
+@lru_cache(maxsize=1)
 def get_main_keyboard():
     """Main menu with auto-grid control buttons"""
     keyboard = [
@@ -176,8 +550,9 @@ def get_main_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=1)
 def get_products_keyboard():
-    """Pair selection keyboard"""
+    """Pair selection keyboard (статична - строится один раз)"""
     keyboard = []
     for product_id, symbol in PRODUCTS.items():
         keyboard.append([InlineKeyboardButton(symbol, callback_data=f'product_{product_id}')])
@@ -189,9 +564,15 @@ def get_wallet_keyboard():
     """Клавиатура выбора кошелька"""
     # Показываем какой кошелек активен
     active = dashboard.active_wallet if dashboard else 1
-    
+    wallet_nums = tuple(sorted(dashboard.wallets.keys())) if dashboard else (1,)
+    return build_wallet_keyboard(active, wallet_nums)
+
+
+@lru_cache(maxsize=16)
+def build_wallet_keyboard(active, wallet_nums):
+    """Клавиатура кошельков - кэшируется по активному кошельку и набору кошельков"""
     keyboard = []
-    for wallet_num in sorted(dashboard.wallets.keys()) if dashboard else [1]:
+    for wallet_num in wallet_nums:
         emoji = "✅" if wallet_num == active else "👛"
         keyboard.append([
             InlineKeyboardButton(
@@ -216,9 +597,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Создаём dashboard (Multi-Wallet Support)
     global dashboard, calc, history_manager
     
-    # ВСЕГДА пересоздаем dashboard
-    logger.info(f"🔗 Creating multi-wallet dashboard for user {user_id}")
-    dashboard = MultiWalletDashboard(leverage=10)
+    # Dashboard создаётся один раз и переиспользуется (клиенты и соединения живут между /start)
+    if dashboard is None:
+        logger.info(f"🔗 Creating multi-wallet dashboard for user {user_id}")
+        dashboard = await asyncio.to_thread(MultiWalletDashboard, leverage=10)
     
     # ✅ СОХРАНЯЕМ dashboard в context сразу после создания!
     context.user_data['dashboard'] = dashboard.get_current_dashboard()
@@ -230,13 +612,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if calc is None:
         calc = TPSLCalculator(leverage=dashboard.leverage)
     
-    welcome_text = (
-        f"🤖 <b>NADO DEX Trading Bot</b>\n\n"
-        f"🌐 Network: <code>{dashboard.network.upper()}</code>\n"
-        f"👛 Wallet: <code>{dashboard.wallet[:10]}...{dashboard.wallet[-8:]}</code>\n"
-        f"⚡ Leverage: <code>{dashboard.leverage}x</code>\n\n"
-        f"Выберите действие:"
-    )
+    welcome_text = build_welcome_text()
     
     if update.message:
         await update.message.reply_text(
@@ -252,13 +628,46 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def build_welcome_text():
+    """Текст главного меню по текущему кошельку"""
+    current = dashboard.get_current_dashboard()
+    wallet = current.wallet
+    return WELCOME_TMPL.format(
+        network=current.network.upper(),
+        wallet=f"{wallet[:10]}...{wallet[-8:]}",
+        leverage=current.leverage,
+    )
+
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Возврат в главное меню - без пересоздания dashboard"""
+    if not check_access(update):
+        return ConversationHandler.END
+    if dashboard is None:
+        # Бот перезапущен, а кнопка из старого сообщения - полная инициализация
+        return await start(update, context)
+    
+    query = update.callback_query
+    ack(query)
+    # Ушли из подтверждения закрытия - снимок позиции больше не нужен
+    context.user_data.pop('close_position', None)
+    await query.message.edit_text(
+        build_welcome_text(),
+        reply_markup=get_main_keyboard(),
+        parse_mode='HTML'
+    )
+    return ConversationHandler.END
+
+
 async def refresh_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Refresh status"""
     query = update.callback_query
-    await query.answer()
     
-    balance = dashboard.get_balance()
-    positions = dashboard.get_positions()
+    # Баланс и позиции независимы - запрашиваем параллельно
+    balance, positions = await asyncio.gather(
+        asyncio.to_thread(dashboard.get_balance),
+        asyncio.to_thread(dashboard.get_positions_cached)
+    )
     
     status_text = (
         "📊 <b>STATUS</b>\n\n"
@@ -278,47 +687,43 @@ async def refresh_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         status_text += "📊 <b>No positions</b>\n"
     
-    await query.edit_message_text(
-        status_text,
-        parse_mode='HTML',
-        reply_markup=get_main_keyboard()
-    )
+    await edit_view(query, context, status_text, get_main_keyboard())
 
 
 async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show balance"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    balance = dashboard.get_balance()
+    balance = await asyncio.to_thread(dashboard.get_balance)
     
     if not balance:
-        await query.edit_message_text(
-            "❌ Failed to get balance",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back')]])
-        )
+        await edit_error(query, "❌ Failed to get balance")
         return
     
-    text = (
-        "💰 <b>ACCOUNT BALANCE</b>\n\n"
-        f"Total Equity: <b>${balance.get('total_equity', balance['equity']):,.2f}</b>\n"
-        f"Available Margin: <b>${balance['health']:,.2f}</b>\n"
+    text = BALANCE_TMPL.format(
+        equity=balance.get('total_equity', balance['equity']),
+        health=balance['health'],
     )
     
     await query.edit_message_text(
         text,
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back')]])
+        reply_markup=BACK_MARKUP
     )
 
 
 async def show_wallets_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню управления кошельками"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    # Получаем информацию о всех кошельках
-    all_balances = dashboard.get_all_balances()
+    # Получаем информацию о всех кошельках - они независимы, запрашиваем параллельно
+    wallet_nums = list(dashboard.wallets)
+    results = await asyncio.gather(
+        *(asyncio.to_thread(dashboard.get_wallet_balance, wallet_num) for wallet_num in wallet_nums)
+    )
+    all_balances = dict(zip(wallet_nums, results))
     active_wallet = dashboard.active_wallet
     
     text = "👛 <b>WALLETS</b>\n\n"
@@ -351,23 +756,24 @@ async def show_wallets_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def switch_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Переключить активный кошелек"""
     query = update.callback_query
-    await query.answer()
     
     # Извлекаем номер кошелька и возвратную страницу из callback_data
-    parts = query.data.split('_')
-    wallet_num = int(parts[2])
-    return_to = parts[3] if len(parts) > 3 else None
+    match = CB_SWITCH_WALLET.match(query.data)
+    wallet_num = int(match.group(1))
+    return_to = match.group(2)
     
     try:
         dashboard.switch_wallet(wallet_num)
         
-        # Если нужно вернуться на страницу позиций
+        # Если нужно вернуться на страницу позиций - show_positions сам отвечает на callback
         if return_to == 'positions':
             await show_positions(update, context)
             return
         
+        ack(query)
+        
         # Иначе показываем подтверждение
-        balance = dashboard.get_balance()
+        balance = await asyncio.to_thread(dashboard.get_balance)
         text = (
             f"✅ <b>Переключено на Wallet {wallet_num}</b>\n\n"
             f"👛 Address: <code>{dashboard.get_current_dashboard().wallet}</code>\n"
@@ -383,125 +789,88 @@ async def switch_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(
             text,
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='wallets_menu')]])
+            reply_markup=BACK_TO_WALLETS_MARKUP
         )
         
     except Exception as e:
-        await query.edit_message_text(
-            f"❌ Ошибка переключения кошелька: {e}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='wallets_menu')]])
-        )
+        await edit_error(query, f"❌ Ошибка переключения кошелька: {e}", 'wallets_menu')
 
 
 async def show_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show prices"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
     text = "📈 <b>CURRENT PRICES</b>\n\n"
     
-    for product_id, symbol in PRODUCTS.items():
-        price = dashboard.get_market_price(product_id)
+    # Цены независимы - запрашиваем параллельно
+    prices = await asyncio.gather(
+        *(asyncio.to_thread(get_cached_price, dashboard, product_id) for product_id in PRODUCTS)
+    )
+    for symbol, price in zip(PRODUCTS.values(), prices):
         if price:
             text += f"{symbol}: <b>${price:,.2f}</b>\n"
     
     await query.edit_message_text(
         text,
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back')]])
+        reply_markup=BACK_MARKUP
     )
 
 
 async def show_positions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Улучшенное отображение позиций с entry, current, P&L и Set TP"""
     query = update.callback_query
-    await query.answer()
+    # «Отмена» в подтверждении закрытия ведёт сюда - снимок позиции больше не нужен
+    context.user_data.pop('close_position', None)
     
-    positions = dashboard.get_positions()
-    
-    # Кнопки управления (всегда доступны)
-    base_keyboard = []
+    # Позиции вместе с сохранёнными входом и TP/SL - один вызов, кэш на POSITIONS_SNAPSHOT_TTL
+    positions = await asyncio.to_thread(dashboard.get_positions_snapshot)
     
     if not positions:
         text = "📊 <b>ПОЗИЦИИ</b>\n\n✅ Нет открытых позиций"
-        # Добавляем кнопку отмены ордеров для каждого продукта
-        for pid, symbol in PRODUCTS.items():
-            base_keyboard.append([
-                InlineKeyboardButton(
-                    f"🚫 Отменить {symbol}",
-                    callback_data=f'cancel_orders_{pid}'
-                )
-            ])
-        base_keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data='positions')])
-        base_keyboard.append([InlineKeyboardButton("« Назад", callback_data='back')])
-        
-        await query.edit_message_text(
-            text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(base_keyboard)
-        )
+        await edit_view(query, context, text, NO_POSITIONS_MARKUP)
         return
     
     # Определяем активный кошелек
+    wallet = dashboard.wallet
     if hasattr(dashboard, 'active_wallet'):
-        wallet_info = f"👛 Wallet {dashboard.active_wallet}: <code>{dashboard.wallet[:10]}...{dashboard.wallet[-8:]}</code>\n\n"
+        wallet_info = f"👛 Wallet {dashboard.active_wallet}: <code>{wallet[:10]}...{wallet[-8:]}</code>\n\n"
     else:
-        wallet_info = f"👛 <code>{dashboard.wallet[:10]}...{dashboard.wallet[-8:]}</code>\n\n"
+        wallet_info = f"👛 <code>{wallet[:10]}...{wallet[-8:]}</code>\n\n"
     
-    text = "📊 <b>ОТКРЫТЫЕ ПОЗИЦИИ</b>\n\n" + wallet_info
+    # Блоки позиций собираем в список и склеиваем один раз
+    lines = ["📊 <b>ОТКРЫТЫЕ ПОЗИЦИИ</b>\n\n" + wallet_info]
     keyboard = []
     
-    for i, pos in enumerate(positions, 1):
-        side_emoji = "🟢" if pos["side"] == "LONG" else "🔴"
-        product_id = pos['product_id']
-        current_price = pos['price']
-        symbol = pos['symbol']
-        amount = abs(pos['amount'])
-        
-        # Получаем entry price из сохраненных данных
-        entry_data = dashboard.entry_prices.get(str(product_id))  # Ключ - строка!
-        
-        if entry_data:
-            entry_price = entry_data['entry_price']
-            tp_price = entry_data.get('tp_price')
-            sl_price = entry_data.get('sl_price')
-        else:
-            entry_price = current_price
-            tp_price = None
-            sl_price = None
-        
-        # Рассчитываем P&L правильно
-        # P&L = (current - entry) * amount для LONG
-        # P&L = (entry - current) * amount для SHORT
-        if pos['side'] == 'LONG':
-            raw_pnl = (current_price - entry_price) * amount
-        else:
-            raw_pnl = (entry_price - current_price) * amount
+    for product_id, symbol, side, amount, current_price, notional, entry_price, tp_price, sl_price in map(POSITION_FIELDS, positions):
+        is_long = side == 'LONG'
+        side_emoji = "🟢" if is_long else "🔴"
+        amount = abs(amount)
         
-        # Процент от вложенного капитала (entry * amount)
-        invested = entry_price * amount
-        pnl_percent = (raw_pnl / invested * 100) if invested > 0 else 0
-        
-        pnl_emoji = "🟢" if raw_pnl >= 0 else "🔴"
-        pnl_str = f"{pnl_emoji} ${raw_pnl:+,.2f} ({pnl_percent:+.2f}%)"
+        # P&L в $ и в % от вложенного капитала (entry * amount)
+        raw_pnl, pnl_percent = calc_pnl(entry_price, current_price, amount, is_long)
         
         # Формируем детальный текст позиции
-        pos_text = (
-            f"{side_emoji} <b>{symbol}</b>\n"
-            f"├ Размер: {amount:.4f}\n"
-            f"├ Вход: ${entry_price:,.2f}\n"
-            f"├ Сейчас: ${current_price:,.2f}\n"
-            f"├ Объем: ${pos['notional']:,.2f}\n"
-            f"└ P&L: {pnl_str}\n"
-        )
+        lines.append(POSITION_TMPL.format(
+            side_emoji=side_emoji,
+            symbol=symbol,
+            amount=amount,
+            entry=fmt_usd(entry_price),
+            current_price=current_price,
+            notional=notional,
+            pnl_emoji="🟢" if raw_pnl >= 0 else "🔴",
+            pnl=raw_pnl,
+            pnl_percent=pnl_percent,
+        ))
         
         # Добавляем TP/SL если установлены
         if tp_price:
-            pos_text += f"   🎯 TP: ${tp_price:,.2f}\n"
+            lines.append(f"   🎯 TP: {fmt_usd(tp_price)}\n")
         if sl_price:
-            pos_text += f"   🛑 SL: ${sl_price:,.2f}\n"
+            lines.append(f"   🛑 SL: {fmt_usd(sl_price)}\n")
         
-        text += pos_text + "\n"
+        lines.append("\n")
         
         # Кнопки управления позицией
         keyboard.append([
@@ -539,13 +908,9 @@ async def show_positions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(wallet_buttons) > 0:
             keyboard.append(wallet_buttons)
     
-    keyboard.append([InlineKeyboardButton("« Назад", callback_data='back')])
+    keyboard.append(BACK_RU_ROW)
     
-    await query.edit_message_text(
-        text,
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    await edit_view(query, context, "".join(lines), InlineKeyboardMarkup(keyboard))
 
 
 async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -557,7 +922,7 @@ async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def select_wallet_for_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выбор кошелька для открытия позиции"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
     is_long = query.data == 'open_long'
     context.user_data['is_long'] = is_long
@@ -588,23 +953,19 @@ async def select_wallet_for_position(update: Update, context: ContextTypes.DEFAU
 async def wallet_selected_for_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка выбора кошелька для позиции"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    wallet_num = int(query.data.split('_')[2])
+    wallet_num = int(CB_POSITION_WALLET.match(query.data).group(1))
     context.user_data['wallet_num'] = wallet_num
     
-    # Переключаемся на выбранный кошелек
-    global dashboard
-    dashboard.switch_wallet(wallet_num)
-    
-    # ✅ СОХРАНЯЕМ dashboard в context!
-    context.user_data['dashboard'] = dashboard.get_current_dashboard()
+    # Привязываем dashboard выбранного кошелька к диалогу, не трогая общий active_wallet -
+    # иначе параллельные пользователи перещёлкивают кошелек друг другу
+    current_dashboard = dashboard.get_isolated_dashboard(wallet_num)
+    context.user_data['dashboard'] = current_dashboard
     
     is_long = context.user_data.get('is_long', True)
     direction = "LONG 🟢" if is_long else "SHORT 🔴"
     
-    current_dashboard = context.user_data['dashboard']
-    
     text = (
         f"<b>{direction}</b>\n\n"
         f"👛 Wallet {wallet_num}: <code>{current_dashboard.wallet[:10]}...{current_dashboard.wallet[-8:]}</code>\n"
@@ -624,14 +985,11 @@ async def wallet_selected_for_position(update: Update, context: ContextTypes.DEF
 async def open_position_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Position opening menu"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
     is_long = query.data == 'open_long'
     context.user_data['is_long'] = is_long
     
-    # Получаем глобальный dashboard для отображения leverage
-    global dashboard
-    
     direction = "LONG 🟢" if is_long else "SHORT 🔴"
     
     text = (
@@ -652,7 +1010,7 @@ async def open_position_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def select_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Pair selection"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
     # Получаем dashboard
     if 'dashboard' in context.user_data:
@@ -661,11 +1019,11 @@ async def select_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ Dashboard not initialized")
         return ConversationHandler.END
     
-    product_id = int(query.data.split('_')[1])
+    product_id = int(CB_PRODUCT.match(query.data).group(1))
     context.user_data['product_id'] = product_id
     
     symbol = PRODUCTS[product_id]
-    price = dashboard.get_market_price(product_id)
+    price = await asyncio.to_thread(get_cached_price, dashboard, product_id)
     is_long = context.user_data.get('is_long', True)
     
     direction = "LONG 🟢" if is_long else "SHORT 🔴"
@@ -673,7 +1031,8 @@ async def select_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         f"<b>{direction} {symbol}</b>\n\n"
         f"💰 Current price: <b>${price:,.2f}</b>\n"
-        f"⚙️ Leverage: <b>{dashboard.leverage}x</b>\n\n"
+        f"⚙️ Leverage: <b>{dashboard.leverage}x</b>\n"
+        f"📏 Min size: <b>{SIZE_INCREMENTS[product_id]}</b>\n\n"
         f"💡 При открытии автоматически разместится\n"
         f"   take-profit ордер (+0.03%)\n\n"
         "Enter base size:"
@@ -713,24 +1072,45 @@ async def handle_size_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return WAITING_SIZE
         
         logger.info("📍 Parsing size...")
-        size = Decimal(size_text)
-        if size <= 0:
-            raise ValueError
+        size_text = size_text.strip()
+        # Нечисловой ввод отсекаем регуляркой - без исключения из Decimal
+        size = Decimal(size_text) if NUMBER_RE.match(size_text) else None
+        if size is None or size <= 0:
+            error_text = "❌ Неверный формат. Введите размер:"
+            if update.message:
+                await message.reply_text(error_text)
+            else:
+                await message.edit_text(error_text)
+            return WAITING_SIZE
         
         logger.info("📍 Getting product_id...")
         product_id = context.user_data['product_id']
         is_long = context.user_data['is_long']
         symbol = PRODUCTS[product_id]
         
-        logger.info("📍 Getting balance...")
-        # ❌ ВОТ ТУТ ПАДАЕТ!
-        balance = dashboard.get_balance()
+        # Минимальный шаг известен заранее - отсекаем до запросов к движку
+        min_size = SIZE_INCREMENTS[product_id]
+        if size < min_size:
+            error_text = f"❌ Size below minimum {min_size}\n\nВведите размер заново:"
+            if update.message:
+                await message.reply_text(error_text)
+            else:
+                await message.edit_text(error_text)
+            return WAITING_SIZE
+        
+        logger.info("📍 Getting balance and price...")
+        # Баланс и цена независимы - запрашиваем параллельно
+        balance, price = await asyncio.gather(
+            asyncio.to_thread(dashboard.get_balance),
+            asyncio.to_thread(get_cached_price, dashboard, product_id)
+        )
         logger.info(f"✅ Balance: {balance}")
         
-        equity = Decimal(str(balance.get('equity', 0)))
+        # Проверка лимита - только сравнение, считаем во float; Decimal остаётся у размера ордера
+        equity = float(balance.get('equity', 0))
         max_size = equity / 5  # Макс 20% депозита
         
-        if size > max_size:
+        if float(size) > max_size:
             reply_text = (
                 f"⚠️ Размер слишком большой!\n\n"
                 f"💰 Ваш баланс: ${equity:,.2f}\n"
@@ -753,51 +1133,36 @@ async def handle_size_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await message.edit_text(error_text)
             return WAITING_SIZE
         
-        # Получаем цену
-        price = dashboard.get_market_price(product_id)
-        size_with_leverage = size * dashboard.leverage
-        notional = size_with_leverage * Decimal(str(price))
+        leverage = dashboard.leverage
+        size_with_leverage = size * leverage
+        price = float(price)
+        notional = float(size_with_leverage) * price
         
-        # Расчет комиссий
-        fee_rate = Decimal("0.0001")
-        open_fee = notional * fee_rate
-        close_fee = notional * fee_rate
+        # Расчет комиссий (открытие и закрытие по одному notional)
+        open_fee = calc_fee(notional)
+        close_fee = open_fee
         total_fee = open_fee + close_fee
         
         # РИСК КАЛЬКУЛЯТОР
         # Ликвидация при движении 1/leverage (например, 10% для 10x)
-        liq_percent = 100 / float(dashboard.leverage)
-        if is_long:
-            liq_price = price * (1 - liq_percent / 100)
-        else:
-            liq_price = price * (1 + liq_percent / 100)
-        
-        # Risk/Reward с типичным TP 5% и SL 2%
-        typical_tp = 5.0
-        typical_sl = 2.0
-        reward = float(notional) * typical_tp / 100
-        risk = float(notional) * typical_sl / 100
-        rr_ratio = reward / risk if risk > 0 else 0
+        liq_price, liq_percent = calc_liquidation(price, leverage, is_long)
         
         direction = "LONG 🟢" if is_long else "SHORT 🔴"
         
-        confirm_text = (
-            f"<b>Confirmation {direction}</b>\n\n"
-            f"📊 {symbol}\n"
-            f"💰 Цена: ${price:,.2f}\n"
-            f"📦 Base size: {size}\n"
-            f"⚡ Leverage: {dashboard.leverage}x\n"
-            f"📈 Position size: {size_with_leverage}\n"
-            f"💵 Notional: ${notional:,.2f}\n\n"
-            f"💰 <b>Fees:</b>\n"
-            f"  Opening: ${open_fee:,.4f}\n"
-            f"  Closing: ${close_fee:,.4f}\n"
-            f"  Total: ${total_fee:,.4f}\n\n"
-            f"⚠️ <b>RISK:</b>\n"
-            f"  🔻 Ликвидация: ${liq_price:,.2f} ({liq_percent:.1f}%)\n"
-            f"  📊 Risk/Reward: 1:{rr_ratio:.1f} (TP {typical_tp}% / SL {typical_sl}%)\n\n"
-            "Open position?"
-        )
+        confirm_text = ORDER_CONFIRM_TMPL.format_map({
+            'direction': direction,
+            'symbol': symbol,
+            'price': price,
+            'size': size,
+            'leverage': leverage,
+            'position_size': size_with_leverage,
+            'notional': notional,
+            'open_fee': open_fee,
+            'close_fee': close_fee,
+            'total_fee': total_fee,
+            'liq_price': liq_price,
+            'liq_percent': liq_percent,
+        })
         
         keyboard = [
             [
@@ -834,47 +1199,63 @@ async def handle_size_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Confirmation и размещение ордера"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
+    
+    # Данные диалога могли быть удалены (перезапуск бота) - кнопка устарела
+    product_id = context.user_data.get('product_id')
+    is_long = context.user_data.get('is_long')
+    if product_id is None or is_long is None:
+        await edit_error(query, SESSION_EXPIRED_TEXT)
+        return
     
     try:
-        size = Decimal(query.data.split('_')[2])
-        product_id = context.user_data['product_id']
-        is_long = context.user_data['is_long']
+        size = Decimal(CB_CONFIRM_ORDER.match(query.data).group(1))
         symbol = PRODUCTS[product_id]
         
-        await query.edit_message_text("🔄 Placing order...")
-        
-        result = dashboard.place_order(product_id, size, is_long)
+        # Кошелек, выбранный в этом диалоге
+        wallet_dashboard = context.user_data.get('dashboard') or dashboard.get_current_dashboard()
         
+        # Сетевой вызов к движку - в потоке, параллельно с сообщением «в процессе»
+        result = await run_with_progress(
+            query, "🔄 Placing order...", wallet_dashboard.place_order, product_id, size, is_long
+        )
+
         if result:
-            # ИСПРАВЛЕНИЕ: Сохраняем entry price СРАЗУ после открытия!
-            current_price = dashboard.get_market_price(product_id)
-            if current_price:
-                dashboard.save_entry_price(
-                    product_id=product_id,
-                    entry_price=current_price,
-                    size=float(size)
-                )
+            # Экран позиций и monitor_tp_sl смотрят только активный кошелек -
+            # после успешного ордера делаем активным кошелек этой позиции
+            wallet_num = context.user_data.get('wallet_num')
+            if wallet_num is not None:
+                dashboard.switch_wallet(wallet_num)
+            MONITOR_WAKEUP.set()
+            # place_order уже сохранил entry price по цене ордера (вместе с TP).
+            # Запрашиваем рынок только если записи нет - иначе лишний запрос и дрейф цены
+            if product_id not in wallet_dashboard.entry_prices:
+                current_price = await asyncio.to_thread(wallet_dashboard.get_market_price, product_id)
+                if current_price:
+                    # Запись на диск - в фоне
+                    run_in_background(
+                        wallet_dashboard.save_entry_price,
+                        product_id=product_id,
+                        entry_price=current_price,
+                        size=float(size)
+                    )
             
             await query.edit_message_text(
                 f"✅ Order placed!\n\n"
                 f"{'🟢 LONG' if is_long else '🔴 SHORT'} {symbol}\n"
-                f"Size: {size * dashboard.leverage}\n\n"
+                f"Size: {size * wallet_dashboard.leverage}\n\n"
                 f"Take-profit ордер активирован (+0.03%)",
                 parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« To menu", callback_data='back')]])
+                reply_markup=TO_MENU_MARKUP
             )
         else:
-            await query.edit_message_text(
-                "❌ Order placement error",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back')]])
-            )
+            await edit_error(query, "❌ Order placement error")
     
     except Exception as e:
         logger.error(f"Error in confirm_order: {e}")
         keyboard = [
             [InlineKeyboardButton("🔄 Retry", callback_data=f'confirm_order_{size}')],
-            [InlineKeyboardButton("« Cancel", callback_data='back')]
+            CANCEL_ROW
         ]
         await query.edit_message_text(
             f"❌ Ошибка размещения ордера:\n{str(e)}\n\nПопробовать еще раз?",
@@ -886,47 +1267,37 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def close_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать подтверждение закрытия позиции"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    product_id = int(query.data.split('_')[1])
+    product_id = int(CB_CLOSE.match(query.data).group(1))
     symbol = PRODUCTS[product_id]
     
     # Получаем данные позиции
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
+    position = await asyncio.to_thread(dashboard.get_position, product_id)
     
     if not position:
-        await query.edit_message_text(
-            f"❌ Позиция {symbol} не найдена",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data='positions')]])
-        )
+        await edit_error(query, f"❌ Позиция {symbol} не найдена", 'positions')
         return
     
+    # Сохраняем позицию для confirm_close_position - без повторного запроса к движку,
+    # пока снимок не старше POSITIONS_CACHE_TTL
+    context.user_data['close_position'] = (time.monotonic(), position)
+    
     # Получаем entry price и рассчитываем P&L
-    entry_data = dashboard.entry_prices.get(str(product_id))
-    entry_price = entry_data['entry_price'] if entry_data else position['price']
+    entry_data = dashboard.entry_prices.get(product_id)
+    entry_price = entry_data.entry_price if entry_data else position['price']
     current_price = position['price']
     amount = abs(position['amount'])
     side = position['side']
     
     # Расчет P&L
-    if side == 'LONG':
-        pnl = (current_price - entry_price) * amount
-    else:
-        pnl = (entry_price - current_price) * amount
-    
-    pnl_percent = (pnl / (entry_price * amount) * 100) if entry_price * amount > 0 else 0
+    pnl, pnl_percent = calc_pnl(entry_price, current_price, amount, side == 'LONG')
     pnl_emoji = "🟢" if pnl >= 0 else "🔴"
     
     # Подтверждение
-    confirm_text = (
-        f"⚠️ <b>ЗАКРЫТЬ ПОЗИЦИЮ?</b>\n\n"
-        f"📊 {symbol} {side}\n"
-        f"💰 Вход: ${entry_price:,.2f}\n"
-        f"💰 Сейчас: ${current_price:,.2f}\n"
-        f"📏 Размер: {amount:.4f}\n\n"
-        f"{pnl_emoji} <b>P&L: ${pnl:+,.2f} ({pnl_percent:+.2f}%)</b>\n\n"
-        f"Подтвердите закрытие:"
+    confirm_text = CLOSE_CONFIRM_TMPL.format(
+        symbol=symbol, side=side, entry_price=entry_price, current_price=current_price,
+        amount=amount, pnl_emoji=pnl_emoji, pnl=pnl, pnl_percent=pnl_percent
     )
     
     keyboard = [
@@ -947,103 +1318,103 @@ async def close_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def confirm_close_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подтверждение - выполнить закрытие позиции"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    product_id = int(query.data.split('_')[2])
+    product_id = int(CB_CONFIRM_CLOSE.match(query.data).group(1))
     symbol = PRODUCTS[product_id]
     
-    # Получаем данные позиции ДО закрытия
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
+    # Получаем данные позиции ДО закрытия: свежий снимок из close_position для этого продукта
+    snapshot_ts, position = context.user_data.pop('close_position', (0.0, None))
+    fresh = (
+        position is not None
+        and position['product_id'] == product_id
+        and time.monotonic() - snapshot_ts < POSITIONS_CACHE_TTL
+    )
+    if not fresh:
+        position = await asyncio.to_thread(dashboard.get_position, product_id)
     
     if not position:
-        await query.edit_message_text(
-            f"❌ Позиция {symbol} не найдена",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data='positions')]])
-        )
+        await edit_error(query, f"❌ Позиция {symbol} не найдена", 'positions')
         return
     
     # Получаем entry price
-    entry_data = dashboard.entry_prices.get(str(product_id))
-    entry_price = entry_data['entry_price'] if entry_data else position['price']
+    entry_data = dashboard.entry_prices.get(product_id)
+    entry_price = entry_data.entry_price if entry_data else position['price']
     
-    # Текущая цена (exit price)
+    # Текущая цена (exit price) - для истории нужна рыночная на момент закрытия
     exit_price = position['price']
+    if not fresh:
+        exit_price = await asyncio.to_thread(dashboard.get_market_price, product_id) or exit_price
     
     # Размер позиции
     position_size = abs(position['amount'])
-    base_size = position_size / float(dashboard.leverage)
+    leverage = dashboard.leverage
+    base_size = position_size / leverage
     
-    await query.edit_message_text(f"🔄 Closing position {symbol}...")
-    
-    result = dashboard.close_position(product_id)
+    result = await run_with_progress(
+        query, f"🔄 Closing position {symbol}...", dashboard.close_position, product_id
+    )
     
     if result:
         # Рассчитываем комиссии
-        entry_notional = entry_price * position_size
-        exit_notional = exit_price * position_size
-        entry_fee = entry_notional * 0.0001
-        exit_fee = exit_notional * 0.0001
+        entry_fee = calc_fee(entry_price * position_size)
+        exit_fee = calc_fee(exit_price * position_size)
         
-        # Записываем в историю
-        history_manager.add_trade(
+        # Записываем в историю в фоне - пользователю не нужно ждать записи на диск
+        run_in_background(
+            history_manager.add_trade,
             symbol=symbol,
             product_id=product_id,
             side=position['side'],
             entry_price=entry_price,
             exit_price=exit_price,
             size=base_size,
-            leverage=dashboard.leverage,
+            leverage=leverage,
             entry_fee=entry_fee,
             exit_fee=exit_fee
         )
         
         await query.edit_message_text(
             f"✅ Позиция {symbol} закрыта!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« To menu", callback_data='back')]])
+            reply_markup=TO_MENU_MARKUP
         )
     else:
-        await query.edit_message_text(
-            f"❌ Position close error {symbol}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back')]])
-        )
+        await edit_error(query, f"❌ Position close error {symbol}")
 
 
 async def cancel_orders_for_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отменить все ордера для продукта"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    product_id = int(query.data.split('_')[2])
+    product_id = int(CB_CANCEL_ORDERS.match(query.data).group(1))
     symbol = PRODUCTS[product_id]
     
     await query.edit_message_text(f"🔄 Отмена ордеров {symbol}...")
     
     try:
-        from nado_protocol.engine_client.types.execute import CancelProductOrdersParams
-        
         params = CancelProductOrdersParams(
             sender=dashboard.sender_hex,  # ИСПРАВЛЕНО: было user_subaccount
             productIds=[product_id]
         )
         
-        result = dashboard.client.market.cancel_product_orders(params)
+        result = await asyncio.to_thread(dashboard.client.market.cancel_product_orders, params)
         
         await query.edit_message_text(
             f"✅ Ордера {symbol} отменены!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« К меню", callback_data='back')]])
+            reply_markup=TO_MENU_RU_MARKUP
         )
     except Exception as e:
         await query.edit_message_text(
             f"❌ Ошибка: {e}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Назад", callback_data='back')]])
+            reply_markup=BACK_RU_MARKUP
         )
 
 
 async def leverage_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Leverage settings"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
     text = (
         "⚙️ <b>НАСТРОЙКА ПЛЕЧА</b>\n\n"
@@ -1064,13 +1435,14 @@ async def leverage_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_leverage_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Leverage input handling"""
-    import logging
-    logger = logging.getLogger(__name__)
     logger.warning(f"handle_leverage_input called with: '{update.message.text}'")
     try:
         text_input = update.message.text.strip()
-        new_leverage = Decimal(text_input)
-        if new_leverage < 1 or new_leverage > 100:
+        # Плечо - целое 1..100 (как и таблица LIQ_PCT_BY_LEVERAGE)
+        if not text_input.isdigit():
+            raise ValueError
+        new_leverage = int(text_input)
+        if not 1 <= new_leverage <= 100:
             raise ValueError
         
         old_leverage = dashboard.leverage
@@ -1088,12 +1460,12 @@ async def handle_leverage_input(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(
             text,
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« To menu", callback_data='back')]])
+            reply_markup=TO_MENU_MARKUP
         )
         
         return ConversationHandler.END
         
-    except Exception as e:
+    except ValueError as e:
         logger.warning(f"handle_leverage_input ERROR: {e}")
         await update.message.reply_text("❌ Invalid format. Введите число от 1 до 100:")
         return WAITING_LEVERAGE
@@ -1107,12 +1479,21 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+def make_conversation_timeout(keys=()):
+    """Обработчик таймаута диалога: брошенный диалог очищает только свои ключи user_data"""
+    async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        for key in keys:
+            context.user_data.pop(key, None)
+        return ConversationHandler.END
+    return conversation_timeout
+
+
 # ============ TP/SL КАЛЬКУЛЯТОР ============
 
 async def tpsl_calculator(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """TP/SL Calculator"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
     text = (
         "🎯 <b>TP/SL КАЛЬКУЛЯТОР</b>\n\n"
@@ -1136,11 +1517,13 @@ async def tpsl_calculator(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def tpsl_select_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Pair selection for калькулятора"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    product_id = int(query.data.split('_')[1])
+    product_id = int(CB_PRODUCT.match(query.data).group(1))
     symbol = PRODUCTS[product_id]
-    price = dashboard.get_market_price(product_id)
+    price = await asyncio.to_thread(get_cached_price, dashboard, product_id)
+    
+    leverage = dashboard.leverage
     
     # Рассчитываем сценарии for примера
     scenarios = calc.calculate_scenarios(
@@ -1154,46 +1537,111 @@ async def tpsl_select_product(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"🎯 <b>TP/SL for {symbol}</b>\n\n"
         f"💰 Current price: <b>${price:,.2f}</b>\n"
         f"📊 Size: 0.5 (пример)\n"
-        f"⚙️ Leverage: {float(dashboard.leverage)}x\n"
-        f"💼 Позиция: {0.5 * float(dashboard.leverage)} {symbol.split('-')[0]}\n\n"
+        f"⚙️ Leverage: {leverage}x\n"
+        f"💼 Позиция: {0.5 * leverage} {PRODUCT_BASES[product_id]}\n\n"
         f"<b>📊 СЦЕНАРИИ:</b>\n\n"
     )
     
     for scenario in scenarios:
         text += calc.format_scenario_text(scenario, symbol) + "\n"
     
-    keyboard = [[InlineKeyboardButton("« Back", callback_data='back')]]
-    
     await query.edit_message_text(
         text,
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=BACK_MARKUP
     )
     
     return ConversationHandler.END  # Завершаем conversation
 
 
-# ============ УСТАНОВКА TAKE PROFIT ============
+async def reply_tpsl_confirmation(update, context, kind, symbol, side,
+                                  entry_price, current_price, target_price, percent, pnl):
+    """Показать подтверждение TP/SL и запомнить цену для confirm-обработчика"""
+    confirm_text = TPSL_CONFIRM_TMPLS[kind].format_map({
+        'symbol': symbol,
+        'side': side,
+        'entry_price': entry_price,
+        'current_price': current_price,
+        'target_price': target_price,
+        'percent': percent,
+        'pnl': pnl,
+    })
+    
+    await update.message.reply_text(
+        confirm_text,
+        parse_mode='HTML',
+        reply_markup=TPSL_CONFIRM_MARKUPS[kind]
+    )
+    
+    context.user_data[f'{kind}_price'] = target_price
+    
+    return ConversationHandler.END
+
 
-async def set_tp_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Меню выбора режима установки TP"""
+# ============ УСТАНОВКА TP/SL: МЕНЮ И РЕЖИМ ============
+
+# Различия TP и SL в общих обработчиках меню, ввода и подтверждения.
+# above_for_long: цель LONG-позиции выше текущей цены (TP) или ниже (SL), для SHORT - наоборот
+TPSL_MENU = {
+    'tp': {
+        'icon': "🎯", 'title': "TAKE PROFIT", 'label': "TP", 'markup': TP_MODE_MARKUP,
+        'percent_prompt': "Введите процент профита:\n(Например: 5 для +5%)",
+        'states': (WAITING_TP_MODE, WAITING_TP_PRICE, WAITING_TP_PERCENT),
+        'above_for_long': True,
+        'price_error': "❌ Неверный формат. Введите цену:",
+        'percent_error': "❌ Неверный формат. Введите процент:",
+        'percent_valid': lambda percent: percent > 0,
+        'percent_invalid': "❌ Процент должен быть > 0\nВведите процент:",
+        'place_method': 'place_tp_order',
+    },
+    'sl': {
+        'icon': "🛑", 'title': "STOP LOSS", 'label': "SL", 'markup': SL_MODE_MARKUP,
+        'percent_prompt': "Введите процент убытка:\n(Например: -5 для -5%)",
+        'states': (WAITING_SL_MODE, WAITING_SL_PRICE, WAITING_SL_PERCENT),
+        'above_for_long': False,
+        'price_error': "❌ Введите число:",
+        'percent_error': "❌ Введите число:",
+        'percent_valid': lambda percent: percent < 0,
+        'percent_invalid': "❌ SL должен быть отрицательным (убыток)\nВведите отрицательный процент:",
+        'place_method': 'place_limit_close_order',
+    },
+}
+
+
+def get_tpsl_position(context, kind):
+    """Позиция и цена входа из меню TP/SL + свежая рыночная цена (через кэш цен)"""
+    product_id = context.user_data[f'{kind}_product_id']
+    position = context.user_data.get(f'{kind}_position')
+    entry_price = context.user_data.get(f'{kind}_entry_price')
+    if position is None or entry_price is None:
+        # Данных меню нет - запрашиваем заново
+        position = dashboard.get_position(product_id)
+        if not position:
+            return None, None, None
+        entry_data = dashboard.entry_prices.get(product_id)
+        entry_price = entry_data.entry_price if entry_data else position['price']
+        context.user_data[f'{kind}_position'] = position
+        context.user_data[f'{kind}_entry_price'] = entry_price
+    current_price = get_cached_price(dashboard, product_id) or position['price']
+    return position, entry_price, current_price
+
+
+async def set_tpsl_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Меню выбора режима установки TP или SL"""
     query = update.callback_query
-    await query.answer()
+    ack(query)
     
-    product_id = int(query.data.split('_')[2])
-    context.user_data['tp_product_id'] = product_id
+    match = CB_SET_TPSL.match(query.data)
+    kind = match.group(1)
+    product_id = int(match.group(2))
+    menu = TPSL_MENU[kind]
+    context.user_data[f'{kind}_product_id'] = product_id
     
     # Получаем информацию о позиции
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
+    position = await asyncio.to_thread(dashboard.get_position, product_id)
     
     if not position:
-        await query.edit_message_text(
-            "❌ Позиция не найдена",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Назад", callback_data='positions')
-            ]])
-        )
+        await edit_error(query, "❌ Позиция не найдена", 'positions')
         return ConversationHandler.END
     
     symbol = position['symbol']
@@ -1202,636 +1650,239 @@ async def set_tp_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Получаем entry price
     entry_data = dashboard.entry_prices.get(product_id)
-    entry_price = entry_data['entry_price'] if entry_data else current_price
-    
-    text = (
-        f"🎯 <b>УСТАНОВИТЬ TAKE PROFIT</b>\n\n"
-        f"📊 {symbol} {side}\n"
-        f"💰 Вход: ${entry_price:,.2f}\n"
-        f"💰 Сейчас: ${current_price:,.2f}\n\n"
-        f"Выберите режим:"
+    entry_price = entry_data.entry_price if entry_data else current_price
+    
+    # Сохраняем на весь диалог - следующие шаги обновляют только рыночную цену
+    context.user_data[f'{kind}_position'] = position
+    context.user_data[f'{kind}_entry_price'] = entry_price
+    
+    text = TPSL_MENU_TMPL.format(
+        icon=menu['icon'],
+        title=menu['title'],
+        symbol=symbol,
+        side=side,
+        entry=fmt_usd(entry_price),
+        current_price=current_price,
     )
     
-    keyboard = [
-        [InlineKeyboardButton("💰 По цене ($)", callback_data='tp_mode_price')],
-        [InlineKeyboardButton("📊 По проценту (%)", callback_data='tp_mode_percent')],
-        [InlineKeyboardButton("« Назад", callback_data='positions')]
-    ]
-    
     await query.edit_message_text(
         text,
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=menu['markup']
     )
     
-    return WAITING_TP_MODE
+    return menu['states'][0]
 
 
-async def tp_mode_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка выбора режима TP"""
+async def tpsl_mode_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка выбора режима TP или SL"""
     query = update.callback_query
-    await query.answer()
-    
-    mode = query.data.split('_')[2]  # 'price' или 'percent'
-    context.user_data['tp_mode'] = mode
+    ack(query)
     
-    product_id = context.user_data['tp_product_id']
+    match = CB_TPSL_MODE.match(query.data)
+    kind = match.group(1)
+    mode = match.group(2)  # 'price' или 'percent'
+    menu = TPSL_MENU[kind]
+    context.user_data[f'{kind}_mode'] = mode
     
-    # Получаем позицию
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
+    # Позиция и вход уже получены в меню TP/SL
+    position, entry_price, current_price = await asyncio.to_thread(get_tpsl_position, context, kind)
     
     if not position:
         await query.edit_message_text("❌ Позиция не найдена")
         return ConversationHandler.END
     
     symbol = position['symbol']
-    current_price = position['price']
     side = position['side']
     
-    # Получаем entry price
-    entry_data = dashboard.entry_prices.get(product_id)
-    entry_price = entry_data['entry_price'] if entry_data else current_price
-    
     if mode == 'price':
         text = (
-            f"🎯 <b>TP ПО ЦЕНЕ</b>\n\n"
+            f"{menu['icon']} <b>{menu['label']} ПО ЦЕНЕ</b>\n\n"
             f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
+            f"💰 Вход: {fmt_usd(entry_price)}\n"
             f"💰 Сейчас: ${current_price:,.2f}\n\n"
-            f"Введите цену TP в $:"
+            f"Введите цену {menu['label']} в $:"
         )
     else:  # percent
         # Рассчитываем текущий P&L в процентах
-        if side == 'LONG':
-            current_pnl_pct = ((current_price - entry_price) / entry_price) * 100
-        else:
-            current_pnl_pct = ((entry_price - current_price) / entry_price) * 100
+        _, current_pnl_pct = calc_pnl(entry_price, current_price, abs(position['amount']), side == 'LONG')
         
         text = (
-            f"🎯 <b>TP ПО ПРОЦЕНТУ</b>\n\n"
+            f"{menu['icon']} <b>{menu['label']} ПО ПРОЦЕНТУ</b>\n\n"
             f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
+            f"💰 Вход: {fmt_usd(entry_price)}\n"
             f"💰 Сейчас: ${current_price:,.2f}\n"
             f"📈 P&L сейчас: {current_pnl_pct:+.2f}%\n\n"
-            f"Введите процент профита:\n"
-            f"(Например: 5 для +5%)"
+            f"{menu['percent_prompt']}"
         )
     
     await query.edit_message_text(text, parse_mode='HTML')
     
     if mode == 'price':
-        return WAITING_TP_PRICE
+        return menu['states'][1]
     else:
-        return WAITING_TP_PERCENT
+        return menu['states'][2]
 
 
-async def handle_tp_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка ввода TP по цене"""
-    try:
-        tp_price = float(update.message.text)
+# ============ УСТАНОВКА TP/SL: ВВОД И ПОДТВЕРЖДЕНИЕ ============
+
+def make_tpsl_price_handler(kind):
+    """Обработчик ввода цены TP или SL"""
+    menu = TPSL_MENU[kind]
+    retry_state = menu['states'][1]
+    
+    async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        target_price = parse_number(update.message.text)
+        if target_price is None:
+            await update.message.reply_text(menu['price_error'])
+            return retry_state
         
-        product_id = context.user_data['tp_product_id']
-        
-        # Получаем позицию
-        positions = dashboard.get_positions()
-        position = next((p for p in positions if p['product_id'] == product_id), None)
+        # Позиция и вход сохранены в меню, цена - свежая
+        position, entry_price, current_price = await asyncio.to_thread(get_tpsl_position, context, kind)
         
         if not position:
             await update.message.reply_text("❌ Позиция не найдена")
             return ConversationHandler.END
         
-        symbol = position['symbol']
         side = position['side']
-        current_price = position['price']
-        
-        # Получаем entry price
-        entry_data = dashboard.entry_prices.get(product_id)
-        entry_price = entry_data['entry_price'] if entry_data else current_price
-        
-        # Валидация
-        if side == 'LONG' and tp_price <= current_price:
-            await update.message.reply_text(
-                f"❌ Для LONG, TP должен быть > текущей цены (${current_price:,.2f})\n"
-                f"Введите новую цену:"
-            )
-            return WAITING_TP_PRICE
+        is_long = side == 'LONG'
         
-        if side == 'SHORT' and tp_price >= current_price:
+        # Валидация: TP - в сторону профита от текущей цены, SL - в сторону убытка
+        above = is_long == menu['above_for_long']
+        if (target_price <= current_price) if above else (target_price >= current_price):
             await update.message.reply_text(
-                f"❌ Для SHORT, TP должен быть < текущей цены (${current_price:,.2f})\n"
+                f"❌ Для {side}, {menu['label']} должен быть {'>' if above else '<'} "
+                f"текущей цены (${current_price:,.2f})\n"
                 f"Введите новую цену:"
             )
-            return WAITING_TP_PRICE
+            return retry_state
         
         # Рассчитываем P&L
-        size = abs(position['amount'])
-        if side == 'LONG':
-            tp_pnl = (tp_price - entry_price) * size
-            tp_percent = ((tp_price - entry_price) / entry_price) * 100
-        else:
-            tp_pnl = (entry_price - tp_price) * size
-            tp_percent = ((entry_price - tp_price) / entry_price) * 100
+        pnl, percent = calc_pnl(entry_price, target_price, abs(position['amount']), is_long)
         
-        # Подтверждение
-        confirm_text = (
-            f"🎯 <b>ПОДТВЕРЖДЕНИЕ TP</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
-            f"💰 Сейчас: ${current_price:,.2f}\n"
-            f"🎯 TP: ${tp_price:,.2f}\n\n"
-            f"Ожидаемый профит:\n"
-            f"📈 {tp_percent:+.2f}%\n"
-            f"💵 ${tp_pnl:+,.2f}\n\n"
-            f"Установить TP?"
+        return await reply_tpsl_confirmation(
+            update, context, kind, position['symbol'], side,
+            entry_price, current_price, target_price, percent, pnl
         )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Да", callback_data=f'confirm_tp_{tp_price}'),
-                InlineKeyboardButton("❌ Нет", callback_data='positions')
-            ]
-        ]
-        
-        await update.message.reply_text(
-            confirm_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        
-        context.user_data['tp_price'] = tp_price
-        
-        return ConversationHandler.END
-        
-    except ValueError:
-        await update.message.reply_text("❌ Неверный формат. Введите цену:")
-        return WAITING_TP_PRICE
-
-
-async def handle_tp_percent(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка ввода TP по проценту"""
-    try:
-        tp_percent = float(update.message.text)
-        
-        if tp_percent <= 0:
-            await update.message.reply_text("❌ Процент должен быть > 0\nВведите процент:")
-            return WAITING_TP_PERCENT
-        
-        product_id = context.user_data['tp_product_id']
-        
-        # Получаем позицию
-        positions = dashboard.get_positions()
-        position = next((p for p in positions if p['product_id'] == product_id), None)
-        
-        if not position:
-            await update.message.reply_text("❌ Позиция не найдена")
-            return ConversationHandler.END
-        
-        symbol = position['symbol']
-        side = position['side']
-        current_price = position['price']
-        
-        # Получаем entry price
-        entry_data = dashboard.entry_prices.get(product_id)
-        entry_price = entry_data['entry_price'] if entry_data else current_price
-        
-        # Рассчитываем TP цену
-        if side == 'LONG':
-            tp_price = entry_price * (1 + tp_percent / 100)
-        else:
-            tp_price = entry_price * (1 - tp_percent / 100)
-        
-        # Рассчитываем P&L
-        size = abs(position['amount'])
-        tp_pnl = (tp_price - entry_price) * size if side == 'LONG' else (entry_price - tp_price) * size
-        
-        # Подтверждение
-        confirm_text = (
-            f"🎯 <b>ПОДТВЕРЖДЕНИЕ TP</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
-            f"💰 Сейчас: ${current_price:,.2f}\n"
-            f"🎯 TP: ${tp_price:,.2f}\n\n"
-            f"Ожидаемый профит:\n"
-            f"📈 +{tp_percent:.2f}%\n"
-            f"💵 ${tp_pnl:+,.2f}\n\n"
-            f"Установить TP?"
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Да", callback_data=f'confirm_tp_{tp_price}'),
-                InlineKeyboardButton("❌ Нет", callback_data='positions')
-            ]
-        ]
-        
-        await update.message.reply_text(
-            confirm_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        
-        context.user_data['tp_price'] = tp_price
-        
-        return ConversationHandler.END
-        
-    except ValueError:
-        await update.message.reply_text("❌ Неверный формат. Введите процент:")
-        return WAITING_TP_PERCENT
-
-
-async def confirm_tp_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Подтверждение и размещение TP ордера"""
-    query = update.callback_query
-    await query.answer()
-    
-    tp_price = float(query.data.split('_')[2])
-    product_id = context.user_data['tp_product_id']
-    
-    # Получаем позицию
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
-    
-    if not position:
-        await query.edit_message_text(
-            "❌ Позиция не найдена",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Назад", callback_data='positions')
-            ]])
-        )
-        return
-    
-    symbol = position['symbol']
-    side = position['side']
-    size = abs(position['amount'])
-    is_long = side == 'LONG'
-    
-    await query.edit_message_text(f"🔄 Устанавливаю TP для {symbol}...")
-    
-    # Размещаем TP ордер
-    result = dashboard.place_tp_order(
-        product_id=product_id,
-        size=float(size),  # ПОЛНЫЙ размер позиции (уже с плечом)
-        is_long=is_long,
-        target_price=tp_price
-    )
     
-    if result:
-        # Обновляем сохраненные данные
-        entry_data = dashboard.entry_prices.get(str(product_id))
-        if entry_data:
-            dashboard.save_entry_price(
-                product_id,
-                entry_data['entry_price'],
-                size,
-                tp_price=tp_price,
-                sl_price=entry_data.get('sl_price')
-            )
-        
-        await query.edit_message_text(
-            f"✅ <b>TP УСТАНОВЛЕН!</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"🎯 TP: ${tp_price:,.2f}\n\n"
-            f"Позиция закроется автоматически при достижении цены",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« К позициям", callback_data='positions')
-            ]])
-        )
-    else:
-        await query.edit_message_text(
-            f"❌ Ошибка установки TP для {symbol}",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Назад", callback_data='positions')
-            ]])
-        )
+    handle_price.__name__ = f'handle_{kind}_price'
+    return handle_price
 
 
-# ============ УСТАНОВКА STOP LOSS ============
-
-async def set_sl_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Меню выбора режима установки SL"""
-    query = update.callback_query
-    await query.answer()
+def make_tpsl_percent_handler(kind):
+    """Обработчик ввода процента TP или SL"""
+    menu = TPSL_MENU[kind]
+    retry_state = menu['states'][2]
     
-    product_id = int(query.data.split('_')[2])
-    context.user_data['sl_product_id'] = product_id
-    
-    # Получаем информацию о позиции
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
-    
-    if not position:
-        await query.edit_message_text(
-            "❌ Позиция не найдена",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Назад", callback_data='positions')
-            ]])
-        )
-        return ConversationHandler.END
-    
-    symbol = position['symbol']
-    current_price = position['price']
-    side = position['side']
-    
-    # Получаем entry price
-    entry_data = dashboard.entry_prices.get(str(product_id))
-    entry_price = entry_data['entry_price'] if entry_data else current_price
-    
-    text = (
-        f"🛑 <b>УСТАНОВИТЬ STOP LOSS</b>\n\n"
-        f"📊 {symbol} {side}\n"
-        f"💰 Вход: ${entry_price:,.2f}\n"
-        f"💰 Сейчас: ${current_price:,.2f}\n\n"
-        f"Выберите режим:"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("💰 По цене ($)", callback_data='sl_mode_price')],
-        [InlineKeyboardButton("📊 По проценту (%)", callback_data='sl_mode_percent')],
-        [InlineKeyboardButton("« Назад", callback_data='positions')]
-    ]
-    
-    await query.edit_message_text(
-        text,
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    
-    return WAITING_SL_MODE
-
-
-async def sl_mode_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка выбора режима SL"""
-    query = update.callback_query
-    await query.answer()
-    
-    mode = query.data.split('_')[2]  # 'price' или 'percent'
-    context.user_data['sl_mode'] = mode
-    
-    product_id = context.user_data['sl_product_id']
-    
-    # Получаем позицию
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
-    
-    if not position:
-        await query.edit_message_text("❌ Позиция не найдена")
-        return ConversationHandler.END
-    
-    symbol = position['symbol']
-    current_price = position['price']
-    side = position['side']
-    
-    # Получаем entry price
-    entry_data = dashboard.entry_prices.get(str(product_id))
-    entry_price = entry_data['entry_price'] if entry_data else current_price
-    
-    if mode == 'price':
-        text = (
-            f"🛑 <b>SL ПО ЦЕНЕ</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
-            f"💰 Сейчас: ${current_price:,.2f}\n\n"
-            f"Введите цену SL в $:"
-        )
-    else:  # percent
-        # Рассчитываем текущий P&L в процентах
-        if side == 'LONG':
-            current_pnl_pct = ((current_price - entry_price) / entry_price) * 100
-        else:
-            current_pnl_pct = ((entry_price - current_price) / entry_price) * 100
+    async def handle_percent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        percent = parse_number(update.message.text)
+        if percent is None:
+            await update.message.reply_text(menu['percent_error'])
+            return retry_state
         
-        text = (
-            f"🛑 <b>SL ПО ПРОЦЕНТУ</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
-            f"💰 Сейчас: ${current_price:,.2f}\n"
-            f"📈 P&L сейчас: {current_pnl_pct:+.2f}%\n\n"
-            f"Введите процент убытка:\n"
-            f"(Например: -5 для -5%)"
-        )
-    
-    await query.edit_message_text(text, parse_mode='HTML')
-    
-    if mode == 'price':
-        return WAITING_SL_PRICE
-    else:
-        return WAITING_SL_PERCENT
-
-
-async def handle_sl_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка ввода SL по цене"""
-    try:
-        sl_price = float(update.message.text)
+        # Валидация знака до запросов к движку
+        if not menu['percent_valid'](percent):
+            await update.message.reply_text(menu['percent_invalid'])
+            return retry_state
         
-        product_id = context.user_data['sl_product_id']
-        
-        # Получаем позицию
-        positions = dashboard.get_positions()
-        position = next((p for p in positions if p['product_id'] == product_id), None)
+        # Позиция и вход сохранены в меню, цена - свежая
+        position, entry_price, current_price = await asyncio.to_thread(get_tpsl_position, context, kind)
         
         if not position:
             await update.message.reply_text("❌ Позиция не найдена")
             return ConversationHandler.END
         
-        symbol = position['symbol']
         side = position['side']
-        current_price = position['price']
-        
-        # Получаем entry price
-        entry_data = dashboard.entry_prices.get(str(product_id))
-        entry_price = entry_data['entry_price'] if entry_data else current_price
+        is_long = side == 'LONG'
         
-        # Валидация
-        if side == 'LONG' and sl_price >= current_price:
-            await update.message.reply_text(
-                f"❌ Для LONG, SL должен быть < текущей цены (${current_price:,.2f})\n"
-                f"Введите новую цену:"
-            )
-            return WAITING_SL_PRICE
-        
-        if side == 'SHORT' and sl_price <= current_price:
-            await update.message.reply_text(
-                f"❌ Для SHORT, SL должен быть > текущей цены (${current_price:,.2f})\n"
-                f"Введите новую цену:"
-            )
-            return WAITING_SL_PRICE
-        
-        # Рассчитываем P&L
-        size = abs(position['amount'])
-        sl_pnl = (sl_price - entry_price) * size if side == 'LONG' else (entry_price - sl_price) * size
-        sl_percent = ((sl_price - entry_price) / entry_price * 100) if side == 'LONG' else ((entry_price - sl_price) / entry_price * 100)
+        # Рассчитываем цену и P&L
+        target_price = calc_target_price(entry_price, percent, is_long)
+        pnl, _ = calc_pnl(entry_price, target_price, abs(position['amount']), is_long)
         
-        # Подтверждение
-        confirm_text = (
-            f"🛑 <b>ПОДТВЕРЖДЕНИЕ SL</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
-            f"💰 Сейчас: ${current_price:,.2f}\n"
-            f"🛑 SL: ${sl_price:,.2f}\n\n"
-            f"Ожидаемый убыток:\n"
-            f"📉 {sl_percent:.2f}%\n"
-            f"💵 ${sl_pnl:+,.2f}\n\n"
-            f"Установить SL?"
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Да", callback_data='confirm_sl_order'),
-                InlineKeyboardButton("❌ Нет", callback_data='positions')
-            ]
-        ]
-        
-        await update.message.reply_text(
-            confirm_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        return await reply_tpsl_confirmation(
+            update, context, kind, position['symbol'], side,
+            entry_price, current_price, target_price, percent, pnl
         )
-        
-        context.user_data['sl_price'] = sl_price
-        
-        return ConversationHandler.END
-        
-    except ValueError:
-        await update.message.reply_text("❌ Введите число:")
-        return WAITING_SL_PRICE
+    
+    handle_percent.__name__ = f'handle_{kind}_percent'
+    return handle_percent
 
 
-async def handle_sl_percent(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка ввода SL по проценту"""
-    try:
-        sl_percent = float(update.message.text)
+def make_tpsl_confirm_handler(kind):
+    """Обработчик подтверждения и размещения TP или SL ордера"""
+    menu = TPSL_MENU[kind]
+    label = menu['label']
+    
+    async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        ack(query)
         
-        product_id = context.user_data['sl_product_id']
+        target_price = context.user_data.get(f'{kind}_price')  # цена сохранена в reply_tpsl_confirmation
+        product_id = context.user_data.get(f'{kind}_product_id')
+        if target_price is None or product_id is None:
+            # Кнопка пережила данные диалога (перезапуск бота)
+            await edit_error(query, SESSION_EXPIRED_TEXT, 'positions')
+            return
         
         # Получаем позицию
-        positions = dashboard.get_positions()
-        position = next((p for p in positions if p['product_id'] == product_id), None)
+        position = await asyncio.to_thread(dashboard.get_position, product_id)
         
         if not position:
-            await update.message.reply_text("❌ Позиция не найдена")
-            return ConversationHandler.END
+            await edit_error(query, "❌ Позиция не найдена", 'positions')
+            return
         
         symbol = position['symbol']
         side = position['side']
-        current_price = position['price']
-        
-        # Получаем entry price
-        entry_data = dashboard.entry_prices.get(str(product_id))
-        entry_price = entry_data['entry_price'] if entry_data else current_price
-        
-        # Валидация
-        if sl_percent >= 0:
-            await update.message.reply_text(
-                f"❌ SL должен быть отрицательным (убыток)\n"
-                f"Введите отрицательный процент:"
-            )
-            return WAITING_SL_PERCENT
-        
-        # Рассчитываем цену
-        if side == 'LONG':
-            sl_price = entry_price * (1 + sl_percent / 100)
-        else:
-            sl_price = entry_price * (1 - sl_percent / 100)
-        
-        # Рассчитываем P&L
-        size = abs(position['amount'])
-        sl_pnl = (sl_price - entry_price) * size if side == 'LONG' else (entry_price - sl_price) * size
-        
-        # Подтверждение
-        confirm_text = (
-            f"🛑 <b>ПОДТВЕРЖДЕНИЕ SL</b>\n\n"
-            f"📊 {symbol} {side}\n"
-            f"💰 Вход: ${entry_price:,.2f}\n"
-            f"💰 Сейчас: ${current_price:,.2f}\n"
-            f"🛑 SL: ${sl_price:,.2f}\n\n"
-            f"Ожидаемый убыток:\n"
-            f"📉 {sl_percent:.2f}%\n"
-            f"💵 ${sl_pnl:+,.2f}\n\n"
-            f"Установить SL?"
-        )
+        size = abs(position['amount'])  # ПОЛНЫЙ размер позиции (уже с плечом)
         
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Да", callback_data='confirm_sl_order'),
-                InlineKeyboardButton("❌ Нет", callback_data='positions')
-            ]
-        ]
-        
-        await update.message.reply_text(
-            confirm_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        # Лимитный reduce_only ордер - сетевой вызов в потоке, параллельно с сообщением «в процессе»
+        result = await run_with_progress(
+            query,
+            f"🔄 Устанавливаю {label} для {symbol}...",
+            getattr(dashboard, menu['place_method']),
+            product_id=product_id,
+            size=float(size),
+            is_long=side == 'LONG',
+            target_price=target_price
         )
         
-        context.user_data['sl_price'] = sl_price
-        
-        return ConversationHandler.END
+        if not result:
+            await edit_error(query, f"❌ Ошибка установки {label} для {symbol}", 'positions')
+            return
         
-    except ValueError:
-        await update.message.reply_text("❌ Введите число:")
-        return WAITING_SL_PERCENT
-
-
-async def confirm_sl_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Подтверждение и размещение SL ордера"""
-    query = update.callback_query
-    await query.answer()
-    
-    sl_price = context.user_data['sl_price']  # ИСПРАВЛЕНО: берём из context
-    product_id = context.user_data['sl_product_id']
-    
-    # Получаем позицию
-    positions = dashboard.get_positions()
-    position = next((p for p in positions if p['product_id'] == product_id), None)
-    
-    if not position:
-        await query.edit_message_text("❌ Позиция не найдена")
-        return
-    
-    symbol = position['symbol']
-    side = position['side']
-    size = abs(position['amount'])
-    is_long = side == 'LONG'
-    
-    # Размещаем SL ЛИМИТНЫЙ ордер (reduce_only)
-    result = dashboard.place_limit_close_order(  # ИСПРАВЛЕНО: лимитный ордер, не маркет!
-        product_id=product_id,
-        size=size,
-        is_long=is_long,
-        target_price=sl_price
-    )
-    
-    if result:
-        # Обновляем сохраненные данные
-        entry_data = dashboard.entry_prices.get(str(product_id))
+        MONITOR_WAKEUP.set()
+        # Обновляем сохраненные данные (запись на диск - в фоне)
+        entry_data = dashboard.entry_prices.get(product_id)
         if entry_data:
-            dashboard.save_entry_price(
+            run_in_background(
+                dashboard.save_entry_price,
                 product_id,
-                entry_data['entry_price'],
+                entry_data.entry_price,
                 size,
-                tp_price=entry_data.get('tp_price'),
-                sl_price=sl_price
+                tp_price=target_price if kind == 'tp' else entry_data.tp_price,
+                sl_price=target_price if kind == 'sl' else entry_data.sl_price
             )
         
         await query.edit_message_text(
-            f"✅ <b>SL УСТАНОВЛЕН!</b>\n\n"
+            f"✅ <b>{label} УСТАНОВЛЕН!</b>\n\n"
             f"📊 {symbol} {side}\n"
-            f"🛑 SL: ${sl_price:,.2f}\n\n"
+            f"{menu['icon']} {label}: ${target_price:,.2f}\n\n"
             f"Позиция закроется автоматически при достижении цены",
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« К позициям", callback_data='positions')
-            ]])
-        )
-    else:
-        await query.edit_message_text(
-            f"❌ Ошибка установки SL для {symbol}",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Назад", callback_data='positions')
-            ]])
+            reply_markup=TO_POSITIONS_MARKUP
         )
+    
+    confirm.__name__ = f'confirm_{kind}_order'
+    return confirm
+
+
+handle_tp_price = make_tpsl_price_handler('tp')
+handle_tp_percent = make_tpsl_percent_handler('tp')
+confirm_tp_order = make_tpsl_confirm_handler('tp')
+
+handle_sl_price = make_tpsl_price_handler('sl')
+handle_sl_percent = make_tpsl_percent_handler('sl')
+confirm_sl_order = make_tpsl_confirm_handler('sl')
 
 
 def main():
@@ -1839,8 +1890,24 @@ def main():
     # Get token
     bot_token = config.get_telegram_token()
     
+    # Быстрый event loop, если установлен - до создания application
+    if uvloop is not None:
+        uvloop.install()
+    
     # Create application
-    application = Application.builder().token(bot_token).build()
+    builder = Application.builder().token(bot_token)
+    
+    # Сглаживаем всплески edit/answer под лимит Telegram вместо 429 (AIORateLimiter требует aiolimiter),
+    # запросы, всё же получившие 429, повторяются
+    try:
+        builder = builder.rate_limiter(AIORateLimiter(
+            overall_max_rate=TG_MAX_RATE, overall_time_period=1, max_retries=TG_MAX_RETRIES
+        ))
+    except RuntimeError:
+        logger.warning("⚠️ aiolimiter не установлен - исходящие сообщения без ограничителя, только повтор после 429")
+        builder = builder.rate_limiter(RetryAfterLimiter())
+    
+    application = builder.build()
     
     # Убран subaccount_handler - больше не нужен!
     
@@ -1850,15 +1917,17 @@ def main():
             CallbackQueryHandler(select_wallet_for_position, pattern='^open_(long|short)$')
         ],
         states={
-            WAITING_WALLET: [CallbackQueryHandler(wallet_selected_for_position, pattern=r'^switch_wallet_\d+$')],
-            WAITING_PRODUCT: [CallbackQueryHandler(select_product, pattern=r'^product_\d+$')],
-            WAITING_SIZE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_size_input)]
+            WAITING_WALLET: [CallbackQueryHandler(wallet_selected_for_position, pattern=CB_POSITION_WALLET)],
+            WAITING_PRODUCT: [CallbackQueryHandler(select_product, pattern=CB_PRODUCT)],
+            WAITING_SIZE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_size_input)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, make_conversation_timeout(OPEN_POSITION_KEYS))]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
-            CallbackQueryHandler(start, pattern='^back$')
+            CallbackQueryHandler(show_main_menu, pattern='^back$')
         ],
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     
     # Leverage settings handler
@@ -1867,10 +1936,12 @@ def main():
             CallbackQueryHandler(leverage_settings, pattern='^leverage_settings$')
         ],
         states={
-            WAITING_LEVERAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_leverage_input)]
+            WAITING_LEVERAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_leverage_input)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, make_conversation_timeout())]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     
     # Обработчик TP/SL Calculatorа
@@ -1879,59 +1950,52 @@ def main():
             CallbackQueryHandler(tpsl_calculator, pattern='^tpsl_calc$')
         ],
         states={
-            WAITING_TPSL_PRODUCT: [CallbackQueryHandler(tpsl_select_product, pattern=r'^product_\d+$')]
+            WAITING_TPSL_PRODUCT: [CallbackQueryHandler(tpsl_select_product, pattern=CB_PRODUCT)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, make_conversation_timeout())]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
-            CallbackQueryHandler(start, pattern='^back$')
+            CallbackQueryHandler(show_main_menu, pattern='^back$')
         ],
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     
-    # TP Setup Handler  
-    tp_handler = ConversationHandler(
+    # TP/SL Setup Handler - один диалог на оба вида, состояния TP и SL не пересекаются
+    text_input = filters.TEXT & ~filters.COMMAND
+    tpsl_setup_handler = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(set_tp_menu, pattern=r'^set_tp_\d+$')
+            CallbackQueryHandler(set_tpsl_menu, pattern=CB_SET_TPSL)
         ],
         states={
             WAITING_TP_MODE: [
-                CallbackQueryHandler(tp_mode_selected, pattern=r'^tp_mode_(price|percent)$')
+                CallbackQueryHandler(tpsl_mode_selected, pattern=r'^tp_mode_(price|percent)$')
             ],
             WAITING_TP_PRICE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_tp_price)
+                MessageHandler(text_input, handle_tp_price)
             ],
             WAITING_TP_PERCENT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_tp_percent)
-            ]
-        },
-        fallbacks=[
-            CommandHandler('cancel', cancel),
-            CallbackQueryHandler(show_positions, pattern='^positions$')
-        ],
-        per_message=False
-    )
-    
-    # SL Setup Handler
-    sl_handler = ConversationHandler(
-        entry_points=[
-            CallbackQueryHandler(set_sl_menu, pattern=r'^set_sl_\d+$')
-        ],
-        states={
+                MessageHandler(text_input, handle_tp_percent)
+            ],
             WAITING_SL_MODE: [
-                CallbackQueryHandler(sl_mode_selected, pattern=r'^sl_mode_(price|percent)$')
+                CallbackQueryHandler(tpsl_mode_selected, pattern=r'^sl_mode_(price|percent)$')
             ],
             WAITING_SL_PRICE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_sl_price)
+                MessageHandler(text_input, handle_sl_price)
             ],
             WAITING_SL_PERCENT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_sl_percent)
-            ]
+                MessageHandler(text_input, handle_sl_percent)
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, make_conversation_timeout(TPSL_SETUP_KEYS))]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
             CallbackQueryHandler(show_positions, pattern='^positions$')
         ],
-        per_message=False
+        # Кнопка TP/SL другой позиции посреди диалога начинает его заново
+        allow_reentry=True,
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     
     # Commands
@@ -1942,138 +2006,160 @@ def main():
     application.add_handler(open_position_handler)
     application.add_handler(leverage_handler)
     application.add_handler(tpsl_handler)
-    application.add_handler(tp_handler)
-    application.add_handler(sl_handler)
-    
-    # Callback handlers
-    application.add_handler(CallbackQueryHandler(start, pattern='^back$'))
-    application.add_handler(CallbackQueryHandler(start, pattern='^main_menu$'))
-    application.add_handler(CallbackQueryHandler(refresh_status, pattern='^refresh$'))
-    application.add_handler(CallbackQueryHandler(show_balance, pattern='^balance$'))
-    application.add_handler(CallbackQueryHandler(show_prices, pattern='^prices$'))
-    application.add_handler(CallbackQueryHandler(show_positions, pattern='^positions$'))
-    application.add_handler(CallbackQueryHandler(show_history, pattern='^history$'))
-    
-    # Wallets handlers
-    application.add_handler(CallbackQueryHandler(show_wallets_menu, pattern='^wallets_menu$'))
-    application.add_handler(CallbackQueryHandler(switch_wallet, pattern=r'^switch_wallet_\d+(_\w+)?$'))
+    application.add_handler(tpsl_setup_handler)
     
     # История - периоды
     async def history_period_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        period = update.callback_query.data.split('_')[2]
+        period = CB_HIST_PERIOD.match(update.callback_query.data).group(1)
         await show_period_summary(update, context, history_manager, period)
-    application.add_handler(CallbackQueryHandler(history_period_handler, pattern=r'^hist_period_'))
     
     # История - детали
     async def history_details_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        parts = update.callback_query.data.split('_')
-        period = parts[2]
-        page = int(parts[3]) if len(parts) > 3 else 0
+        match = CB_HIST_DETAILS.match(update.callback_query.data)
+        period = match.group(1)
+        page = int(match.group(2) or 0)
         await show_period_details(update, context, history_manager, period, page)
-    application.add_handler(CallbackQueryHandler(history_details_handler, pattern=r'^hist_details_'))
     
-    application.add_handler(CallbackQueryHandler(confirm_order, pattern='^confirm_order_'))
-    application.add_handler(CallbackQueryHandler(close_position, pattern=r'^close_\d+$'))
-    application.add_handler(CallbackQueryHandler(confirm_close_position, pattern=r'^confirm_close_\d+$'))
-    application.add_handler(CallbackQueryHandler(cancel_orders_for_product, pattern=r'^cancel_orders_\d+$'))
-    application.add_handler(CallbackQueryHandler(confirm_tp_order, pattern=r'^confirm_tp_'))
-    application.add_handler(CallbackQueryHandler(confirm_sl_order, pattern='^confirm_sl_order$'))
+    # Callback handlers - все callback вне диалогов маршрутизируются одним обработчиком.
+    # Меню без параметров - точное совпадение
+    menu_routes = {
+        'back': show_main_menu,
+        'main_menu': show_main_menu,
+        'refresh': refresh_status,
+        'balance': show_balance,
+        'prices': show_prices,
+        'positions': show_positions,
+        'history': show_history,
+        'wallets_menu': show_wallets_menu,
+    }
+    
+    # С параметрами - префикс до первого '_' сужает проверку до 1-4 шаблонов
+    param_routes = {
+        'confirm': (
+            (CB_CONFIRM_ORDER, confirm_order),
+            (CB_CONFIRM_CLOSE, confirm_close_position),
+            (CB_CONFIRM_TP, confirm_tp_order),
+            (CB_CONFIRM_SL, confirm_sl_order),
+        ),
+        'close': ((CB_CLOSE, close_position),),
+        'cancel': ((CB_CANCEL_ORDERS, cancel_orders_for_product),),
+        'switch': ((CB_SWITCH_WALLET, switch_wallet),),
+        'hist': (
+            (CB_HIST_PERIOD, history_period_handler),
+            (CB_HIST_DETAILS, history_details_handler),
+        ),
+    }
+    
+    def route_callback(data):
+        """Найти обработчик для callback_data (None - не наш callback)"""
+        # Кнопки без callback_data (игровые/inline-запросы) - не наши
+        if not data:
+            return None
+        handler = menu_routes.get(data)
+        if handler:
+            return handler
+        for pattern, handler in param_routes.get(data.partition('_')[0], ()):
+            if pattern.match(data):
+                return handler
+        return None
+    
+    @drop_duplicate_callbacks
+    async def callback_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        handler = route_callback(update.callback_query.data)
+        if handler is None:
+            return
+        await handler(update, context)
+    application.add_handler(CallbackQueryHandler(callback_dispatcher, pattern=route_callback))
     
     # Запускаем фоновый мониторинг TP/SL
     async def monitor_tp_sl():
         """Мониторинг сработавших TP/SL"""
         previous_positions = {}
+        bot = application.bot
         
         while True:
             try:
-                await asyncio.sleep(15)  # Проверка каждые 15 секунд
+                # Ждём интервал или сигнал о новом ордере
+                interval = MONITOR_INTERVAL if previous_positions else MONITOR_IDLE_INTERVAL
+                try:
+                    await asyncio.wait_for(MONITOR_WAKEUP.wait(), timeout=interval)
+                except asyncio.TimeoutError:
+                    pass
+                MONITOR_WAKEUP.clear()
                 
                 # Пропускаем если dashboard не инициализирован
                 if dashboard is None:
                     continue
                 
-                # Получаем текущие позиции
-                current_positions = dashboard.get_positions()
-                current_ids = {p['product_id'] for p in current_positions}
+                # Активный кошелек берём один раз за цикл - без повторных proxy-обращений
+                wallet_dashboard = dashboard.get_current_dashboard()
+                entry_prices = wallet_dashboard.entry_prices
+                
+                # Ни у одной позиции нет TP/SL - уведомлять не о чем, движок не опрашиваем
+                if not any(e.tp_price or e.sl_price for e in entry_prices.values()):
+                    previous_positions = {}
+                    continue
+                
+                # Получаем текущие позиции - индекс по product_id станет previous_positions
+                current_positions = await asyncio.to_thread(wallet_dashboard.get_positions_by_id)
+                
+                # Закрывшиеся позиции с сохранённым входом - последние цены запрашиваем параллельно
+                closed_ids = [pid for pid in previous_positions.keys() - current_positions.keys()
+                              if pid in entry_prices]
+                last_prices = await asyncio.gather(
+                    *(asyncio.to_thread(wallet_dashboard.get_market_price, pid) for pid in closed_ids)
+                )
                 
                 # Проверяем закрытые позиции
-                for prev_id, prev_data in previous_positions.items():
-                    if prev_id not in current_ids:
-                        # Позиция закрылась!
-                        entry_data = dashboard.entry_prices.get(str(prev_id))
+                for prev_id, last_price in zip(closed_ids, last_prices):
+                    # Позиция закрылась!
+                    prev_data = previous_positions[prev_id]
+                    entry_data = entry_prices.get(prev_id)
+                    
+                    if entry_data:
+                        entry_price = entry_data.entry_price
+                        tp_price = entry_data.tp_price
+                        sl_price = entry_data.sl_price
                         
-                        if entry_data:
-                            entry_price = entry_data['entry_price']
-                            tp_price = entry_data.get('tp_price')
-                            sl_price = entry_data.get('sl_price')
-                            
-                            # Получаем последнюю цену
-                            last_price = dashboard.get_market_price(prev_id)
-                            
-                            # Определяем что сработало
-                            symbol = PRODUCTS[prev_id]
-                            side = prev_data['side']
-                            
-                            if tp_price and last_price:
-                                # Проверяем сработал ли TP
-                                if (side == 'LONG' and last_price >= tp_price) or \
-                                   (side == 'SHORT' and last_price <= tp_price):
-                                    # TP сработал!
-                                    pnl = (last_price - entry_price) * abs(prev_data['amount']) if side == 'LONG' else \
-                                          (entry_price - last_price) * abs(prev_data['amount'])
-                                    
-                                    for user_id in ALLOWED_USERS:
-                                        try:
-                                            await application.bot.send_message(
-                                                user_id,
-                                                f"🎯 <b>TAKE PROFIT СРАБОТАЛ!</b>\n\n"
-                                                f"📊 {symbol} {side}\n"
-                                                f"💰 Вход: ${entry_price:,.2f}\n"
-                                                f"💰 TP: ${tp_price:,.2f}\n"
-                                                f"🟢 <b>Профит: ${pnl:+,.2f}</b>",
-                                                parse_mode='HTML'
-                                            )
-                                        except Exception as e:
-                                            logger.error(f"Error sending TP notification: {e}")
-                            
-                            if sl_price and last_price:
-                                # Проверяем сработал ли SL
-                                if (side == 'LONG' and last_price <= sl_price) or \
-                                   (side == 'SHORT' and last_price >= sl_price):
-                                    # SL сработал!
-                                    pnl = (last_price - entry_price) * abs(prev_data['amount']) if side == 'LONG' else \
-                                          (entry_price - last_price) * abs(prev_data['amount'])
-                                    
-                                    for user_id in ALLOWED_USERS:
-                                        try:
-                                            await application.bot.send_message(
-                                                user_id,
-                                                f"🛑 <b>STOP LOSS СРАБОТАЛ!</b>\n\n"
-                                                f"📊 {symbol} {side}\n"
-                                                f"💰 Вход: ${entry_price:,.2f}\n"
-                                                f"💰 SL: ${sl_price:,.2f}\n"
-                                                f"🔴 <b>Убыток: ${pnl:+,.2f}</b>",
-                                                parse_mode='HTML'
-                                            )
-                                        except Exception as e:
-                                            logger.error(f"Error sending SL notification: {e}")
+                        # Определяем что сработало
+                        symbol = PRODUCTS[prev_id]
+                        side = prev_data['side']
+                        amount = abs(prev_data['amount'])
+                        if last_price:
+                            pnl, _ = calc_pnl(entry_price, last_price, amount, side == 'LONG')
+                        
+                        if tp_price and last_price:
+                            # Проверяем сработал ли TP
+                            if (side == 'LONG' and last_price >= tp_price) or \
+                               (side == 'SHORT' and last_price <= tp_price):
+                                # TP сработал!
+                                await broadcast(bot, TP_HIT_TMPL.format(
+                                    symbol=symbol, side=side, entry_price=entry_price,
+                                    tp_price=tp_price, pnl=pnl
+                                ))
+                        
+                        if sl_price and last_price:
+                            # Проверяем сработал ли SL
+                            if (side == 'LONG' and last_price <= sl_price) or \
+                               (side == 'SHORT' and last_price >= sl_price):
+                                # SL сработал!
+                                await broadcast(bot, SL_HIT_TMPL.format(
+                                    symbol=symbol, side=side, entry_price=entry_price,
+                                    sl_price=sl_price, pnl=pnl
+                                ))
                 
                 # Обновляем previous_positions
-                previous_positions = {p['product_id']: p for p in current_positions}
+                previous_positions = current_positions
                 
             except Exception as e:
                 logger.error(f"Error in monitor_tp_sl: {e}")
                 await asyncio.sleep(30)
     
-    # Запускаем мониторинг в фоне
-    async def start_monitoring():
-        """Запуск фонового мониторинга"""
-        await asyncio.sleep(5)  # Ждем 5 секунд после старта
-        asyncio.create_task(monitor_tp_sl())
-    
     # Хук для запуска после старта
     async def post_init(application):
-        await start_monitoring()
+        # Без фиксированной паузы: post_init задерживает старт polling,
+        # а monitor_tp_sl и так ждёт интервал перед первой проверкой
+        spawn(monitor_tp_sl())
     
     application.post_init = post_init
     
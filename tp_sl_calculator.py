@@ -1,7 +1,6 @@
 """
 TP/SL Калькулятор с примерами прибыли/убытков
 """
-from decimal import Decimal
 from typing import List, Dict
 
 
@@ -15,9 +14,9 @@ class TPSLCalculator:
     SCALPING = {"tp": 0.3, "sl": 0.15}         # Скальпинг
     TEST = {"tp": 5.0, "sl": 3.0}              # ТЕСТ - большие %
     
-    def __init__(self, leverage: int = 10, maker_fee: Decimal = Decimal("0.0001")):
+    def __init__(self, leverage: int = 10, maker_fee: float = 0.0001):
         self.leverage = leverage
-        self.maker_fee = maker_fee  # 0.01%
+        self.maker_fee = float(maker_fee)  # 0.01%
     
     def calculate_scenarios(
         self,
@@ -68,11 +67,12 @@ class TPSLCalculator:
     ) -> Dict:
         """Рассчитать один сценарий"""
         
-        entry = Decimal(str(entry_price))
-        base_size = Decimal(str(size))
+        # Значения только для отображения - считаем во float, без Decimal
+        entry = float(entry_price)
+        base_size = float(size)
         
         # Размер позиции с плечом
-        position_size = base_size * self.leverage
+        position_size = base_size * float(self.leverage)
         
         # Notional (стоимость позиции)
         notional = position_size * entry
@@ -99,26 +99,26 @@ class TPSLCalculator:
             "name": name,
             "tp_percent": tp_percent,
             "sl_percent": sl_percent,
-            "tp_price": float(tp_price),
-            "sl_price": float(sl_price),
-            "tp_pnl": float(tp_pnl),
-            "sl_pnl": float(sl_pnl),
-            "rr_ratio": float(rr_ratio),
-            "position_size": float(position_size),
-            "notional": float(notional)
+            "tp_price": tp_price,
+            "sl_price": sl_price,
+            "tp_pnl": tp_pnl,
+            "sl_pnl": sl_pnl,
+            "rr_ratio": rr_ratio,
+            "position_size": position_size,
+            "notional": notional
         }
     
     def _calculate_prices(
         self,
-        entry: Decimal,
+        entry: float,
         is_long: bool,
         tp_percent: float,
         sl_percent: float
     ) -> tuple:
         """Рассчитать цены TP и SL"""
         
-        tp_mult = Decimal(str(1 + tp_percent / 100))
-        sl_mult = Decimal(str(1 - sl_percent / 100))
+        tp_mult = 1 + tp_percent / 100
+        sl_mult = 1 - sl_percent / 100
         
         if is_long:
             # LONG: TP выше, SL ниже
@@ -133,12 +133,12 @@ class TPSLCalculator:
     
     def _calculate_pnl(
         self,
-        entry: Decimal,
-        exit: Decimal,
-        position_size: Decimal,
-        notional: Decimal,
+        entry: float,
+        exit: float,
+        position_size: float,
+        notional: float,
         is_long: bool
-    ) -> Decimal:
+    ) -> float:
         """Рассчитать P&L с учетом комиссий"""
         
         # Изменение цены
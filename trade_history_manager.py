@@ -3,10 +3,16 @@
 """
 import json
 import os
+import threading
 from datetime import datetime, timedelta
 from decimal import Decimal
 from typing import List, Dict, Optional
 
+# add_trade вызывается из фоновых потоков бота (run_in_background) - изменение
+# self.trades и запись файла идут под одной блокировкой; RLock, т.к. add_trade
+# и clear_history вызывают save_history уже под ней
+_history_lock = threading.RLock()
+
 
 class TradeHistoryManager:
     def __init__(self, history_file='trade_history.json'):
@@ -21,13 +27,20 @@ class TradeHistoryManager:
         try:
             with open(self.history_file, 'r') as f:
                 return json.load(f)
-        except:
+        except (OSError, ValueError):
             return []
     
     def save_history(self):
         """Сохранить историю в файл"""
-        with open(self.history_file, 'w') as f:
-            json.dump(self.trades, f, indent=2)
+        # json.dumps без indent идёт через C-энкодер (json.dump и indent - чистый Python);
+        # формат файла остаётся JSON-массивом, совместимым с load_history
+        with _history_lock:
+            data = json.dumps(self.trades)
+            # Пишем во временный файл и атомарно подменяем - читатель не увидит обрезанный JSON
+            tmp_file = self.history_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(data)
+            os.replace(tmp_file, self.history_file)
     
     def add_trade(self, 
                   symbol: str,
@@ -94,8 +107,9 @@ class TradeHistoryManager:
             'roi_percent': roi_percent
         }
         
-        self.trades.append(trade)
-        self.save_history()
+        with _history_lock:
+            self.trades.append(trade)
+            self.save_history()
         
         return trade
     
@@ -206,5 +220,6 @@ class TradeHistoryManager:
     
     def clear_history(self):
         """Очистить всю историю"""
-        self.trades = []
-        self.save_history()
+        with _history_lock:
+            self.trades = []
+            self.save_history()
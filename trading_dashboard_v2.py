@@ -6,6 +6,8 @@ import sys
 import os
 import json
 import time
+import logging
+import traceback
 
 # Исправление кодировки для Windows
 if os.name == 'nt':  # Windows
@@ -16,15 +18,21 @@ if os.name == 'nt':  # Windows
         pass
 
 from nado_protocol.client import create_nado_client, NadoClientMode
-from nado_protocol.engine_client.types.execute import PlaceMarketOrderParams
-from nado_protocol.utils.execute import MarketOrderParams
+from nado_protocol.engine_client.types.execute import PlaceMarketOrderParams, PlaceOrderParams, CancelOrdersParams
+from nado_protocol.utils.execute import MarketOrderParams, OrderParams
+from nado_protocol.utils.order import build_appendix, OrderType
 from nado_protocol.utils import SubaccountParams, subaccount_to_hex
 from decimal import ROUND_DOWN
 import config
 from decimal import Decimal
 import time
+import threading
+from dataclasses import dataclass, asdict
+from typing import Optional
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 # Доступные торговые пары
 PRODUCTS = {
     2: "BTC-PERP",
@@ -33,6 +41,9 @@ PRODUCTS = {
     20: "INK-PERP",
 }
 
+# Базовый актив пары ("BTC" для "BTC-PERP") - считается один раз
+PRODUCT_BASES = {pid: symbol.split('-')[0] for pid, symbol in PRODUCTS.items()}
+
 SIZE_INCREMENTS = {
     2: Decimal("0.001"),  # BTC
     4: Decimal("0.01"),   # ETH
@@ -54,6 +65,23 @@ PRICE_INCREMENTS_X18 = {
     20: 10000000000000000,    # INK: 0.01
 }
 
+# Сколько секунд позиции из get_positions_cached считаются свежими
+POSITIONS_CACHE_TTL = 2.0
+# Экран позиций бота: повторные нажатия «Обновить» в пределах секунды не ходят на биржу
+POSITIONS_SNAPSHOT_TTL = 1.0
+
+@dataclass
+class EntryInfo:
+    """Сохранённые данные позиции: вход, размер и цены TP/SL"""
+    __slots__ = ('entry_price', 'size', 'tp_price', 'sl_price')
+    entry_price: float
+    size: float
+    tp_price: Optional[float]
+    sl_price: Optional[float]
+
+# Файлы позиций пишутся и из event loop, и из фоновых потоков бота
+_positions_file_lock = threading.Lock()
+
 class TradingDashboard:
     def normalize_size(self, product_id, size: Decimal) -> Decimal:
     	step = SIZE_INCREMENTS[product_id]
@@ -69,17 +97,23 @@ class TradingDashboard:
             if os.path.exists(self.positions_file):
                 with open(self.positions_file, 'r') as f:
                     data = json.load(f)
-                    # Конвертируем ключи обратно в int
-                    return {int(k): v for k, v in data.items()}
-        except:
+                    # Конвертируем ключи обратно в int, записи - в EntryInfo
+                    return {
+                        int(k): EntryInfo(v['entry_price'], v['size'], v.get('tp_price'), v.get('sl_price'))
+                        for k, v in data.items()
+                    }
+        except (OSError, ValueError, KeyError):
             pass
         return {}
     
     def save_positions_data(self):
         """Сохранить данные позиций в файл"""
         try:
-            with open(self.positions_file, 'w') as f:
-                json.dump(self.entry_prices, f)
+            # Снимок словаря (dict() атомарен под GIL) - запись может идти из фонового потока.
+            # JSON требует строковые ключи - конвертируем только при записи
+            data = json.dumps({str(k): asdict(v) for k, v in dict(self.entry_prices).items()})
+            with _positions_file_lock, open(self.positions_file, 'w') as f:
+                f.write(data)
         except Exception as e:
             print(f"⚠️ Ошибка сохранения данных позиций: {e}")
     
@@ -89,7 +123,7 @@ class TradingDashboard:
             if os.path.exists(self.history_file):
                 with open(self.history_file, 'r') as f:
                     return json.load(f)
-        except:
+        except (OSError, ValueError):
             pass
         return []
     
@@ -103,8 +137,6 @@ class TradingDashboard:
     
     def add_trade_to_history(self, product_id, symbol, side, size, entry_price, exit_price, pnl):
         """Добавить сделку в историю"""
-        from datetime import datetime
-        
         trade = {
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'product_id': product_id,
@@ -122,12 +154,12 @@ class TradingDashboard:
     
     def save_entry_price(self, product_id, entry_price, size, tp_price=None, sl_price=None):
         """Сохранить цену входа для позиции"""
-        self.entry_prices[product_id] = {
-            'entry_price': float(entry_price),
-            'size': float(size),
-            'tp_price': float(tp_price) if tp_price else None,
-            'sl_price': float(sl_price) if sl_price else None
-        }
+        self.entry_prices[int(product_id)] = EntryInfo(
+            entry_price=float(entry_price),
+            size=float(size),
+            tp_price=float(tp_price) if tp_price else None,
+            sl_price=float(sl_price) if sl_price else None
+        )
         self.save_positions_data()
     
     def remove_entry_price(self, product_id):
@@ -142,7 +174,7 @@ class TradingDashboard:
             return None
         
         entry_data = self.entry_prices[product_id]
-        entry_price = Decimal(str(entry_data['entry_price']))
+        entry_price = Decimal(str(entry_data.entry_price))
         current_price = Decimal(str(current_price))
         amount = Decimal(str(amount))
         
@@ -171,7 +203,6 @@ class TradingDashboard:
                 
         except Exception as e:
             print(f"   ❌ Ошибка размещения TP ордера: {e}")
-            import traceback
             traceback.print_exc()
             return None
     
@@ -240,101 +271,17 @@ class TradingDashboard:
                 
         except Exception as e:
             print(f"   ❌ Ошибка размещения SL ордера: {e}")
-            import traceback
             traceback.print_exc()
             return None
+        finally:
+            self.invalidate_positions_cache()
     
-    def place_limit_close_order(self, product_id, size, is_long, target_price):
-        """Разместить лимитный ордер на закрытие позиции"""
-        try:
-            from nado_protocol.engine_client.types.execute import PlaceOrderParams
-            from nado_protocol.utils.execute import OrderParams
-            from nado_protocol.utils.order import build_appendix, OrderType
-            import time
-            
-            size = Decimal(size)
-            size = self.normalize_size(product_id, size)
-            
-            # Размер позиции (без плеча для закрытия)
-            amount_x18 = int((size * Decimal(10) ** 18).to_integral_value())
-            
-            # Для закрытия LONG нужен SHORT ордер (отрицательный amount)
-            # Для закрытия SHORT нужен LONG ордер (положительный amount)
-            if is_long:
-                amount_x18 = -amount_x18  # Продаем для закрытия LONG
-            # else: amount_x18 остается положительным для закрытия SHORT
-            
-            step_x18 = int(SIZE_INCREMENTS[product_id] * Decimal(10) ** 18)
-            if amount_x18 % step_x18 != 0:
-                raise ValueError(f"amount_x18 {amount_x18} не кратен шагу {step_x18}")
-            
-            target_price_decimal = Decimal(str(target_price))
-            
-            # Создаем ордер для закрытия (IOC - immediate or cancel)
-            appendix = build_appendix(
-                order_type=OrderType.DEFAULT,  # IOC для немедленного исполнения
-                isolated=False,
-                reduce_only=True  # ВАЖНО: только для закрытия позиции
-            )
-            
-            # Рассчитываем price_x18
-            price_x18_raw = int((target_price_decimal * Decimal(10**18)).to_integral_value())
-            price_increment = PRICE_INCREMENTS_X18[product_id]
-            price_x18 = (price_x18_raw // price_increment) * price_increment
-            
-            # Expiration: 7 дней (take-profit может висеть долго)
-            expiration = int(time.time()) + (7 * 24 * 60 * 60)
-            
-            # Создаем OrderParams
-            order = OrderParams(
-                sender=self.sender_hex,
-                amount=amount_x18,
-                priceX18=price_x18,
-                expiration=expiration,
-                appendix=appendix
-            )
-            
-            # Создаем PlaceOrderParams
-            params = PlaceOrderParams(
-                product_id=product_id,
-                order=order
-            )
-            
-            # Размещаем ордер
-            result = self.client.market.place_order(params)
-            
-            return result
-            
-        except Exception as e:
-            print(f"❌ Ошибка размещения лимитного ордера на закрытие: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
-        """Рассчитать P&L для позиции"""
-        if product_id not in self.entry_prices:
-            return None
-        
-        entry_data = self.entry_prices[product_id]
-        entry_price = Decimal(str(entry_data['entry_price']))
-        current_price = Decimal(str(current_price))
-        amount = Decimal(str(amount))
-        
-        if amount > 0:  # LONG
-            pnl = (current_price - entry_price) * amount
-        else:  # SHORT
-            pnl = (entry_price - current_price) * abs(amount)
-        
-        return float(pnl)	
-
     def __init__(self, leverage=10):
         """
         Инициализация через приватный ключ из .env
         Args:
             leverage: Плечо (по умолчанию 10x)
         """
-        import logging
-        logger = logging.getLogger(__name__)
-        
         network = config.get_network()
         mode = NadoClientMode.MAINNET if network == "mainnet" else NadoClientMode.TESTNET
         
@@ -425,11 +372,44 @@ class TradingDashboard:
             print(f"Ошибка получения позиций: {e}")
             return []
     
+    def get_positions_by_id(self):
+        """Получить открытые позиции в виде словаря {product_id: позиция}"""
+        return {p['product_id']: p for p in self.get_positions()}
+    
+    def get_positions_cached(self, ttl=POSITIONS_CACHE_TTL):
+        """Позиции {product_id: позиция} с кэшем на ttl секунд - для шагов одного диалога бота"""
+        now = time.monotonic()
+        cached = getattr(self, '_positions_cache', None)
+        if cached and now - cached[0] < ttl:
+            return cached[1]
+        positions = self.get_positions_by_id()
+        self._positions_cache = (now, positions)
+        return positions
+    
+    def get_position(self, product_id, ttl=POSITIONS_CACHE_TTL):
+        """Одна позиция по product_id (из кэша позиций) или None"""
+        return self.get_positions_cached(ttl).get(product_id)
+    
+    def get_positions_snapshot(self, ttl=POSITIONS_SNAPSHOT_TTL):
+        """Позиции для экрана бота одним проходом: данные биржи + сохранённые вход и TP/SL"""
+        snapshot = []
+        for pos in self.get_positions_cached(ttl).values():
+            entry_data = self.entry_prices.get(pos['product_id'])
+            snapshot.append({
+                **pos,
+                "entry_price": entry_data.entry_price if entry_data else pos['price'],
+                "tp_price": entry_data.tp_price if entry_data else None,
+                "sl_price": entry_data.sl_price if entry_data else None,
+            })
+        return snapshot
+    
+    def invalidate_positions_cache(self):
+        """Сбросить кэш позиций - вызывается в finally ордеров, меняющих позицию: после ответа движка,
+        чтобы запрос позиций во время ордера не закэшировал состояние до него"""
+        self._positions_cache = None
+    
     def get_open_orders(self):
         """Получить открытые ордера"""
-        import logging
-        logger = logging.getLogger(__name__)
-        
         try:
             # Используем правильный метод API для всех продуктов
             product_ids = list(PRODUCTS.keys())
@@ -469,7 +449,6 @@ class TradingDashboard:
             return open_orders
         except Exception as e:
             logger.error(f"❌ Ошибка получения ордеров: {e}")
-            import traceback
             traceback.print_exc()
             return []
     
@@ -513,11 +492,6 @@ class TradingDashboard:
             client_order_id: Уникальный ID ордера для фильтрации (опционально)
         """
         try:
-            from nado_protocol.engine_client.types.execute import PlaceOrderParams
-            from nado_protocol.utils.execute import OrderParams
-            from nado_protocol.utils.order import build_appendix, OrderType
-            import time
-            
             size = Decimal(size)
             size = self.normalize_size(product_id, size)
             
@@ -562,9 +536,9 @@ class TradingDashboard:
             )
             
             print(f"\n📊 Параметры ордера:")
-            print(f"   Базовый размер: {size} {PRODUCTS[product_id].split('-')[0]}")
+            print(f"   Базовый размер: {size} {PRODUCT_BASES[product_id]}")
             print(f"   Плечо: {self.leverage}x")
-            print(f"   Размер позиции: {size_with_leverage} {PRODUCTS[product_id].split('-')[0]}")
+            print(f"   Размер позиции: {size_with_leverage} {PRODUCT_BASES[product_id]}")
             print(f"   Цена лимита: ${price:,.2f}")
             print(f"   Notional: ${notional:,.2f}")
             
@@ -648,20 +622,16 @@ class TradingDashboard:
             
         except Exception as e:
             print(f"❌ Ошибка размещения ордера: {e}")
-            import traceback
             traceback.print_exc()
             return None
+        finally:
+            self.invalidate_positions_cache()
     
     def close_position(self, product_id, amount=None):
         """Закрыть позицию РЫНОЧНЫМ ордером"""
         try:
-            from nado_protocol.engine_client.types.execute import PlaceMarketOrderParams
-            from nado_protocol.utils.execute import MarketOrderParams
-            import time
-            
             # Получаем текущую позицию
-            positions = self.get_positions()
-            current_pos = next((p for p in positions if p['product_id'] == product_id), None)
+            current_pos = self.get_positions_by_id().get(product_id)
             
             if not current_pos:
                 print(f"   ❌ Позиция не найдена")
@@ -710,9 +680,7 @@ class TradingDashboard:
             if result:
                 print(f"   ✅ Market order исполнен")
                 # Удаляем entry price
-                if str(product_id) in self.entry_prices:
-                    del self.entry_prices[str(product_id)]
-                    self.save_positions_data()
+                self.remove_entry_price(product_id)
                 return result
             else:
                 print(f"   ❌ Ошибка исполнения market order")
@@ -720,18 +688,14 @@ class TradingDashboard:
                 
         except Exception as e:
             print(f"❌ Ошибка закрытия позиции: {e}")
-            import traceback
             traceback.print_exc()
             return None
+        finally:
+            self.invalidate_positions_cache()
     
     def place_limit_close_order(self, product_id, size, is_long, target_price):
         """Разместить лимитный ордер на закрытие позиции (для TP/SL)"""
         try:
-            from nado_protocol.engine_client.types.execute import PlaceOrderParams
-            from nado_protocol.utils.execute import OrderParams
-            from nado_protocol.utils.order import build_appendix, OrderType
-            import time
-            
             # Нормализуем размер
             size = self.normalize_size(product_id, Decimal(str(size)))
             
@@ -787,18 +751,14 @@ class TradingDashboard:
             
         except Exception as e:
             print(f"❌ Ошибка размещения лимитного ордера на закрытие: {e}")
-            import traceback
             traceback.print_exc()
             return None
+        finally:
+            self.invalidate_positions_cache()
     
     def cancel_order(self, product_id, order_digest):
         """Отменить ордер"""
-        import logging
-        logger = logging.getLogger(__name__)
-        
         try:
-            from nado_protocol.engine_client.types.execute import CancelOrdersParams
-            
             # Создаем параметры для отмены
             params = CancelOrdersParams(
                 sender=self.sender_hex,
@@ -819,7 +779,6 @@ class TradingDashboard:
             
         except Exception as e:
             logger.error(f"❌ Ошибка отмены ордера: {e}")
-            import traceback
             traceback.print_exc()
             return None
     
@@ -1072,7 +1031,6 @@ class TradingDashboard:
                 break
             except Exception as e:
                 print(f"\n❌ Ошибка: {e}")
-                import traceback
                 traceback.print_exc()
                 input("\nНажмите Enter для продолжения...")
     
@@ -1101,7 +1059,7 @@ class TradingDashboard:
             return
         
         # Ввод размера
-        asset = symbol.split("-")[0]
+        asset = PRODUCT_BASES[product_id]
         size_str = input(f"\nРазмер в {asset}: ")
         
         from decimal import Decimal, ROUND_DOWN
@@ -1263,7 +1221,7 @@ class TradingDashboard:
             return
         
         price_decimal = Decimal(str(price))
-        asset = symbol.split("-")[0]
+        asset = PRODUCT_BASES[product_id]
         
         print(f"\n💰 Текущая цена {symbol}: ${price:,.2f}")
         
@@ -1353,7 +1311,6 @@ def main():
         dashboard.main_menu()
     except Exception as e:
         print(f"\n❌ Критическая ошибка: {e}")
-        import traceback
         traceback.print_exc()
 
 if __name__ == "__main__":
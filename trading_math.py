@@ -0,0 +1,42 @@
+"""
+Общая математика позиций: P&L, комиссии, ликвидация.
+Все функции работают только с float - Decimal приводится на стороне вызова.
+"""
+from typing import Tuple
+
+# Комиссия мейкера (0.01%)
+FEE_RATE = 0.0001
+
+# Процент движения до ликвидации для каждого допустимого плеча (1-100)
+LIQ_PCT_BY_LEVERAGE = {lev: 100.0 / lev for lev in range(1, 101)}
+
+
+def calc_pnl(entry_price: float, current_price: float, amount: float, is_long: bool) -> Tuple[float, float]:
+    """P&L позиции в $ и в % от стоимости входа"""
+    # Знак направления вместо ветвления: SHORT зарабатывает на падении
+    sign = 1.0 if is_long else -1.0
+    pnl = sign * (current_price - entry_price) * amount
+    invested = entry_price * amount
+    pnl_percent = (pnl / invested * 100) if invested > 0 else 0.0
+    return pnl, pnl_percent
+
+
+def calc_target_price(entry_price: float, percent: float, is_long: bool) -> float:
+    """Цена, при которой P&L позиции составит percent % от входа"""
+    sign = 1.0 if is_long else -1.0
+    return entry_price * (1 + sign * percent / 100)
+
+
+def calc_fee(notional: float) -> float:
+    """Комиссия за одну сторону сделки"""
+    return notional * FEE_RATE
+
+
+def calc_liquidation(price: float, leverage: float, is_long: bool) -> Tuple[float, float]:
+    """Цена ликвидации и расстояние до неё в % (движение 1/leverage)"""
+    liq_percent = LIQ_PCT_BY_LEVERAGE.get(leverage) or 100.0 / float(leverage)
+    if is_long:
+        liq_price = price * (1 - liq_percent / 100)
+    else:
+        liq_price = price * (1 + liq_percent / 100)
+    return liq_price, liq_percent